@@ -3,33 +3,230 @@ Admin API for User Management and Key Generation
 Runs on port 5500
 """
 from flask import Flask, request, jsonify
-from flask_cors import CORS
 from crypto_utils import CryptoManager
+import orjson
 import sqlite3
 import datetime
 import os
-import shutil
+import threading
+import queue
+import atexit
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 app = Flask(__name__)
-CORS(app)
+
+# Open CORS policy for the admin UI, stamped directly on every response
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET,POST,PUT,DELETE,OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type'
+}
+
+
+@app.before_request
+def preflight():
+    """Answer CORS preflight requests without reaching the route handlers"""
+    if request.method == 'OPTIONS':
+        return app.response_class(status=204)
+
+
+@app.after_request
+def add_cors_headers(response):
+    response.headers.update(CORS_HEADERS)
+    return response
 
 # Initialize crypto manager
 crypto_manager = CryptoManager(keys_dir="keys")
 
 DB_FILE = "admin.db"
 
+# Stay under SQLite's bound-parameter limit when building IN (...) lists
+SQL_MAX_PARAMS = 500
+
+# One cached connection per worker thread (reused across requests)
+_db_local = threading.local()
+
+
+# ==================== SQL ====================
+# Fixed statement text, so sqlite3's per-connection statement cache
+# (cached_statements, 128 by default) reuses the prepared statement every request
+
+SQL_INSERT_USER = '''
+    INSERT INTO users (username, actor_name, role, email, created_at, active)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+SQL_INSERT_ACTIVITY = '''
+    INSERT INTO activity_log (user_id, action, timestamp, details)
+    VALUES (?, ?, ?, ?)
+'''
+
+# Undo a user whose key generation failed (see create_user)
+SQL_DELETE_USER_ACTIVITY = 'DELETE FROM activity_log WHERE user_id = ?'
+SQL_DELETE_USER = 'DELETE FROM users WHERE id = ?'
+
+SQL_LIST_USERS = '''
+    SELECT id, username, actor_name, role, email, created_at, active
+    FROM users
+    WHERE active = 1
+    ORDER BY created_at DESC
+'''
+
+SQL_GET_USER_ROLE = 'SELECT role FROM users WHERE id = ?'
+
+# Existence check + update in one statement; a field is only changed when
+# its flag is set (i.e. the key was present in the request body)
+SQL_UPDATE_USER = '''
+    UPDATE users
+    SET email = CASE WHEN ? THEN ? ELSE email END,
+        active = CASE WHEN ? THEN ? ELSE active END
+    WHERE id = ?
+    RETURNING username
+'''
+
+SQL_DEACTIVATE_USER = '''
+    UPDATE users SET active = 0
+    WHERE id = ? AND role != 'admin'
+    RETURNING username
+'''
+
+SQL_ACTORS_BY_ROLE = '''
+    SELECT actor_name, username, email, created_at
+    FROM users
+    WHERE role = ? AND active = 1
+    ORDER BY created_at DESC
+'''
+
+SQL_USER_COUNTS = '''
+    SELECT COALESCE(SUM(active = 1), 0),
+           COALESCE(SUM(role = 'supplier' AND active = 1), 0),
+           COALESCE(SUM(role = 'distributor' AND active = 1), 0),
+           COALESCE(SUM(role = 'retailer' AND active = 1), 0)
+    FROM users
+'''
+
+SQL_RECENT_ACTIVITY = '''
+    SELECT u.username, a.action, a.timestamp, a.details
+    FROM activity_log a
+    JOIN users u ON a.user_id = u.id
+    ORDER BY a.timestamp DESC
+    LIMIT 10
+'''
+
+# Keyset pagination: pass the oldest timestamp already seen as the cursor
+SQL_ACTIVITY_LOG = '''
+    SELECT u.username, u.actor_name, a.action, a.timestamp, a.details
+    FROM activity_log a
+    JOIN users u ON a.user_id = u.id
+    WHERE (? IS NULL OR a.timestamp < ?)
+    ORDER BY a.timestamp DESC
+    LIMIT ?
+'''
+
 
 def get_db():
-    """Get database connection"""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    """Get this thread's database connection (opened once, then reused)"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None,
+                               cached_statements=128)
+        conn.row_factory = sqlite3.Row
+
+        # Per-connection tuning (journal_mode is persistent and set in init_db)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA cache_size=-20000")
+
+        _db_local.conn = conn
     return conn
 
 
+@app.before_request
+def open_db():
+    """Make sure the worker thread has its connection before the handler runs"""
+    get_db()
+
+
+@app.teardown_appcontext
+def finish_db(exc):
+    """Settle any open transaction; the connection itself stays cached"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None and conn.in_transaction:
+        if exc is None:
+            conn.commit()
+        else:
+            conn.rollback()
+
+
+# Activity timestamps are stored as INTEGER nanoseconds since the epoch (UTC)
+ACTIVITY_LOG_SCHEMA = '''
+    CREATE TABLE {if_not_exists}activity_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        action TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        details TEXT,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )
+'''
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def ns_to_iso(ns):
+    """Format a nanosecond UTC timestamp the way datetime.utcnow().isoformat() does"""
+    seconds, remainder = divmod(ns, 1_000_000_000)
+    return datetime.datetime.utcfromtimestamp(seconds).replace(microsecond=remainder // 1000).isoformat()
+
+
+def _iso_to_ns(iso):
+    """Parse an ISO timestamp (naive means UTC) into nanoseconds since the epoch"""
+    dt = datetime.datetime.fromisoformat(iso)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    delta = dt - _EPOCH
+    return (delta // datetime.timedelta(microseconds=1)) * 1000
+
+
+def _migrate_activity_timestamps(conn):
+    """Rewrite a legacy activity_log (ISO TEXT timestamps) to INTEGER nanoseconds"""
+    columns = {row['name']: row['type'] for row in conn.execute('PRAGMA table_info(activity_log)')}
+    if columns.get('timestamp', '').upper() != 'TEXT':
+        return
+
+    rows = conn.execute('SELECT id, user_id, action, timestamp, details FROM activity_log').fetchall()
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute('ALTER TABLE activity_log RENAME TO activity_log_legacy')
+        conn.execute(ACTIVITY_LOG_SCHEMA.format(if_not_exists=''))
+        conn.executemany('''
+            INSERT INTO activity_log (id, user_id, action, timestamp, details)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(r['id'], r['user_id'], r['action'], _iso_to_ns(r['timestamp']), r['details']) for r in rows])
+        conn.execute('DROP TABLE activity_log_legacy')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    print(f"✅ Migrated {len(rows)} activity log entries to integer timestamps")
+
+
 def init_db():
     """Initialize database with tables"""
     conn = get_db()
 
+    # WAL lets readers proceed while a writer commits; stored in the DB file
+    conn.execute("PRAGMA journal_mode=WAL")
+
+    # Only takes effect on a fresh database (before any table exists)
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+
     # Users table
     conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -44,83 +241,184 @@ def init_db():
     ''')
 
     # Activity log table
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS activity_log (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            action TEXT NOT NULL,
-            timestamp TEXT NOT NULL,
-            details TEXT,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        )
-    ''')
+    conn.execute(ACTIVITY_LOG_SCHEMA.format(if_not_exists='IF NOT EXISTS '))
+    _migrate_activity_timestamps(conn)
+
+    # Indexes for the hot listing filters
+    # (role, active) also lets get_stats aggregate straight from the index
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_active_created ON users(active, created_at DESC)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_role_active ON users(role, active)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_activity_ts ON activity_log(timestamp DESC)')
 
     # Create default admin if doesn't exist
     try:
-        conn.execute('''
-            INSERT INTO users (username, actor_name, role, email, created_at, active)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', ('admin', 'Admin', 'admin', 'admin@supply.com',
-              datetime.datetime.utcnow().isoformat(), 1))
+        conn.execute(SQL_INSERT_USER, ('admin', 'Admin', 'admin', 'admin@supply.com',
+                                       datetime.datetime.utcnow().isoformat(), 1))
         conn.commit()
         print("✅ Default admin user created")
     except sqlite3.IntegrityError:
         print("ℹ️  Admin user already exists")
 
-    conn.close()
     print("✅ Database initialized")
 
 
-def log_activity(user_id, action, details=""):
-    """Log user activity"""
+# Activity entries are queued and written in batches by a background thread
+_log_queue = queue.Queue()
+LOG_BATCH_SIZE = 64
+LOG_FLUSH_INTERVAL = 0.05  # seconds
+
+
+def _write_activity_batch(batch):
+    """Insert a batch of activity rows in a single transaction"""
     conn = get_db()
-    conn.execute('''
-        INSERT INTO activity_log (user_id, action, timestamp, details)
-        VALUES (?, ?, ?, ?)
-    ''', (user_id, action, datetime.datetime.utcnow().isoformat(), details))
-    conn.commit()
-    conn.close()
+    conn.execute("BEGIN")
+    try:
+        conn.executemany(SQL_INSERT_ACTIVITY, batch)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _activity_log_writer():
+    """Drain the activity queue: up to LOG_BATCH_SIZE rows or LOG_FLUSH_INTERVAL per commit"""
+    while True:
+        batch = [_log_queue.get()]
+        deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+
+        while len(batch) < LOG_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_log_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        try:
+            _write_activity_batch(batch)
+        except Exception as e:
+            print(f"❌ Failed to write {len(batch)} activity log entries: {str(e)}")
+        finally:
+            for _ in batch:
+                _log_queue.task_done()
+
+
+@atexit.register
+def flush_activity_log():
+    """Wait until the writer has committed every queued entry, including a batch it is holding"""
+    _log_queue.join()
+
+
+def _exit_on_sigterm(signum, frame):
+    """docker stop sends SIGTERM: exit normally so flush_activity_log still runs"""
+    sys.exit(0)
+
+
+threading.Thread(target=_activity_log_writer, daemon=True).start()
+
+
+def log_activity(user_id, action, details="", conn=None):
+    """
+    Log user activity
+    With conn, the row is written inside the caller's open transaction and
+    committed with it; otherwise it is queued for the background writer.
+    """
+    row = (user_id, action, time.time_ns(), details)
+    if conn is not None:
+        conn.execute(SQL_INSERT_ACTIVITY, row)
+    else:
+        _log_queue.put(row)
+
 
+# Worker threads for copying keys into the API directories
+_key_copy_pool = ThreadPoolExecutor(max_workers=3)
 
-def distribute_keys_to_apis(actor_name):
+
+def _read_key_file(path):
+    """Read a key file once; returns (bytes, stat) for writing to every destination"""
+    with open(path, 'rb') as f:
+        return f.read(), os.fstat(f.fileno())
+
+
+def _write_key_file(dst, data, src_stat, mode=0o644):
+    """Write key bytes to dst and carry over the source timestamps (like shutil.copy2)"""
+    fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with open(fd, 'wb') as f:
+        f.write(data)
+    os.utime(dst, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+
+
+# API directories that receive a copy of every actor's keys - CORRECTED PATHS
+API_KEY_DIRECTORIES = [
+    '../SupplierAPI/SupplierAPI/keys',
+    '../DistributorAPI/DistributorAPI/keys',
+    '../RetailerAPI/RetailerAPI/keys'
+]
+
+
+def prepare_api_key_directories():
+    """
+    Create the API key directories if needed and return them
+    A directory that can't be created is reported here and its key copies
+    then fail (and are reported) per directory; this never raises
+    """
+    for api_dir in API_KEY_DIRECTORIES:
+        if os.path.isdir(api_dir):
+            continue
+        try:
+            os.makedirs(api_dir, exist_ok=True)
+            print(f"✅ Created directory: {api_dir}")
+        except OSError as e:
+            print(f"❌ Failed to create directory {api_dir}: {str(e)}")
+    return API_KEY_DIRECTORIES
+
+
+def distribute_keys_to_apis(actor_name, api_directories=None, key_files=None):
     """
     Copy generated keys to all API directories
+
+    api_directories: directories already known to exist (see prepare_api_key_directories)
+    key_files: filenames present in ./keys, so callers handling many actors
+               can list the directory once instead of stat-ing every key
     """
-    # Define API directories - CORRECTED PATHS
-    api_directories = [
-        '../SupplierAPI/SupplierAPI/keys',
-        '../DistributorAPI/DistributorAPI/keys',
-        '../RetailerAPI/RetailerAPI/keys'
-    ]
+    if api_directories is None:
+        api_directories = prepare_api_key_directories()
 
     # Source files in main keys directory
-    public_key_source = f'./keys/{actor_name}_public.pem'
-    private_key_source = f'./keys/{actor_name}_private.pem'
+    public_key_name = f'{actor_name}_public.pem'
+    private_key_name = f'{actor_name}_private.pem'
+    public_key_source = f'./keys/{public_key_name}'
+    private_key_source = f'./keys/{private_key_name}'
 
     # Check if source files exist
-    if not os.path.exists(public_key_source) or not os.path.exists(private_key_source):
+    if key_files is not None:
+        sources_exist = public_key_name in key_files and private_key_name in key_files
+    else:
+        sources_exist = os.path.exists(public_key_source) and os.path.exists(private_key_source)
+
+    # Keys are small: read each source once and write the bytes to every directory
+    try:
+        if not sources_exist:
+            raise FileNotFoundError(public_key_source)
+        public_key_bytes, public_key_stat = _read_key_file(public_key_source)
+        private_key_bytes, private_key_stat = _read_key_file(private_key_source)
+    except FileNotFoundError:
         return {
             'success': False,
             'error': 'Source key files not found',
             'locations': []
         }
 
-    results = []
-
-    for api_dir in api_directories:
+    def _copy_one(api_dir):
         try:
-            # Create directory if it doesn't exist
-            if not os.path.exists(api_dir):
-                os.makedirs(api_dir)
-                print(f"✅ Created directory: {api_dir}")
-
             # Copy public key
-            public_key_dest = os.path.join(api_dir, f'{actor_name}_public.pem')
-            shutil.copy2(public_key_source, public_key_dest)
+            public_key_dest = os.path.join(api_dir, public_key_name)
+            _write_key_file(public_key_dest, public_key_bytes, public_key_stat)
 
             # Copy private key
-            private_key_dest = os.path.join(api_dir, f'{actor_name}_private.pem')
-            shutil.copy2(private_key_source, private_key_dest)
+            private_key_dest = os.path.join(api_dir, private_key_name)
+            _write_key_file(private_key_dest, private_key_bytes, private_key_stat, 0o600)
 
             # Set permissions on private key (Unix-like systems)
             try:
@@ -128,20 +426,30 @@ def distribute_keys_to_apis(actor_name):
             except:
                 pass  # Windows doesn't support chmod
 
-            results.append({
+            print(f"✅ Keys copied to: {api_dir}")
+
+            return {
                 'directory': api_dir,
                 'success': True
-            })
-
-            print(f"✅ Keys copied to: {api_dir}")
+            }
 
         except Exception as e:
-            results.append({
+            print(f"❌ Failed to copy keys to {api_dir}: {str(e)}")
+            return {
                 'directory': api_dir,
                 'success': False,
                 'error': str(e)
-            })
-            print(f"❌ Failed to copy keys to {api_dir}: {str(e)}")
+            }
+
+    # The API directories are independent, so copy into all of them at once
+    futures = [_key_copy_pool.submit(_copy_one, api_dir) for api_dir in api_directories]
+    by_directory = {}
+    for future in as_completed(futures):
+        result = future.result()
+        by_directory[result['directory']] = result
+
+    # Report in the same order as api_directories
+    results = [by_directory[api_dir] for api_dir in api_directories]
 
     return {
         'success': all(r['success'] for r in results),
@@ -149,6 +457,11 @@ def distribute_keys_to_apis(actor_name):
     }
 
 
+def ojson(obj, status=200):
+    """jsonify() equivalent encoded with orjson (C encoder, much faster on large listings)"""
+    return app.response_class(orjson.dumps(obj), status=status, mimetype='application/json')
+
+
 # ==================== ENDPOINTS ====================
 
 @app.route('/admin/health', methods=['GET'])
@@ -161,20 +474,33 @@ def health_check():
     })
 
 
+VALID_ROLES = frozenset({'supplier', 'distributor', 'retailer', 'admin'})
+
+USER_COLUMNS = ('id', 'username', 'actor_name', 'role', 'email', 'created_at', 'active')
+
+# Fallback values for actors that have keys but no user record
+_DEFAULT_USER = {
+    'username': 'Unknown',
+    'role': 'unknown',
+    'email': '',
+    'has_keys': True,
+    'active': False,
+    'created_at': ''
+}
+_ACTOR_USER_COLUMNS = ('username', 'role', 'email', 'active', 'created_at')
+
+
 @app.route('/admin/users', methods=['GET'])
 def list_users():
     """Get all active users"""
-    conn = get_db()
-    users = conn.execute('''
-        SELECT id, username, actor_name, role, email, created_at, active
-        FROM users 
-        WHERE active = 1
-        ORDER BY created_at DESC
-    ''').fetchall()
-    conn.close()
-
-    return jsonify({
-        'users': [dict(user) for user in users],
+    # Plain tuples straight off the cursor, zipped once into the response dicts
+    cursor = get_db().cursor()
+    cursor.row_factory = None
+    cursor.execute(SQL_LIST_USERS)
+    users = [dict(zip(USER_COLUMNS, row)) for row in cursor]
+
+    return ojson({
+        'users': users,
         'count': len(users)
     })
 
@@ -191,61 +517,58 @@ def create_user():
             return jsonify({'error': f'Missing required field: {field}'}), 400
 
     username = data['username'].strip()
-    role = data['role'].lower()
+    role = data['role'].strip().lower()
     email = data.get('email', '').strip()
 
     # Validate role
-    valid_roles = ['supplier', 'distributor', 'retailer', 'admin']
-    if role not in valid_roles:
-        return jsonify({'error': f'Invalid role. Must be one of: {valid_roles}'}), 400
+    if role not in VALID_ROLES:
+        return jsonify({'error': f'Invalid role. Must be one of: {sorted(VALID_ROLES)}'}), 400
 
     # Generate actor name based on role and username
-    actor_name = f"{role.title()}_{username}"
+    actor_name = f"{role.capitalize()}_{username}"
+
+    conn = get_db()
 
     try:
-        # Check if username or actor already exists
-        conn = get_db()
-        existing = conn.execute('''
-            SELECT id FROM users WHERE username = ? OR actor_name = ?
-        ''', (username, actor_name)).fetchone()
-
-        if existing:
-            conn.close()
+        # Short write transaction for the user row and its log entry; the
+        # UNIQUE constraints on username/actor_name do the existence check
+        # atomically. Key generation runs after commit so the write lock
+        # isn't held through RSA keygen and file copies.
+        conn.execute("BEGIN IMMEDIATE")
+
+        try:
+            cursor = conn.execute(SQL_INSERT_USER, (
+                username,
+                actor_name,
+                role,
+                email,
+                datetime.datetime.utcnow().isoformat(),
+                1
+            ))
+        except sqlite3.IntegrityError:
+            conn.rollback()
             return jsonify({'error': 'Username or actor name already exists'}), 400
 
+        user_id = cursor.lastrowid
+        log_activity(user_id, 'user_created', f'Created user {username} with role {role}', conn=conn)
+        conn.commit()
+
         # Generate cryptographic keys
         print(f"🔐 Generating keys for {actor_name}...")
-        key_result = crypto_manager.register_actor(actor_name)
+        try:
+            key_result = crypto_manager.register_actor(actor_name)
+        except Exception:
+            _delete_created_user(conn, user_id)
+            raise
 
         if not key_result.get('registered'):
-            conn.close()
+            _delete_created_user(conn, user_id)
             return jsonify({'error': 'Failed to generate crypto keys'}), 500
 
-        # Copy keys to all API directories
+        # Copy keys to all API directories (failures are reported per directory)
         print(f"📁 Distributing keys to API directories...")
         distribution_result = distribute_keys_to_apis(actor_name)
 
-        # Save user to database
-        cursor = conn.execute('''
-            INSERT INTO users (username, actor_name, role, email, created_at, active)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (
-            username,
-            actor_name,
-            role,
-            email,
-            datetime.datetime.utcnow().isoformat(),
-            1
-        ))
-
-        user_id = cursor.lastrowid
-        conn.commit()
-
-        # Log activity
-        log_activity(user_id, 'user_created', f'Created user {username} with role {role}')
-
-        conn.close()
-
         print(f"✅ User {username} created successfully")
 
         return jsonify({
@@ -266,10 +589,24 @@ def create_user():
         }), 201
 
     except Exception as e:
+        if conn.in_transaction:
+            conn.rollback()
         print(f"❌ Error creating user: {str(e)}")
         return jsonify({'error': f'Failed to create user: {str(e)}'}), 500
 
 
+def _delete_created_user(conn, user_id):
+    """Remove a just-created user (and its log entry) whose keys couldn't be generated"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(SQL_DELETE_USER_ACTIVITY, (user_id,))
+        conn.execute(SQL_DELETE_USER, (user_id,))
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
 @app.route('/admin/users/<int:user_id>', methods=['PUT'])
 def update_user(user_id):
     """Update user information"""
@@ -277,28 +614,18 @@ def update_user(user_id):
 
     conn = get_db()
 
-    # Check if user exists
-    user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+    # Update the fields that were sent; no row back means no such user
+    user = conn.execute(SQL_UPDATE_USER, (
+        'email' in data, data.get('email'),
+        'active' in data, data.get('active'),
+        user_id
+    )).fetchone()
     if not user:
-        conn.close()
         return jsonify({'error': 'User not found'}), 404
 
-    # Update fields
-    email = data.get('email', user['email'])
-    active = data.get('active', user['active'])
-
-    conn.execute('''
-        UPDATE users 
-        SET email = ?, active = ?
-        WHERE id = ?
-    ''', (email, active, user_id))
-    conn.commit()
-
     # Log activity
     log_activity(user_id, 'user_updated', f'Updated user {user["username"]}')
 
-    conn.close()
-
     return jsonify({
         'success': True,
         'message': 'User updated successfully'
@@ -310,26 +637,20 @@ def delete_user(user_id):
     """Deactivate a user (soft delete)"""
     conn = get_db()
 
-    # Check if user exists
-    user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+    # Soft delete (deactivate) in one statement; admins are never matched
+    user = conn.execute(SQL_DEACTIVATE_USER, (user_id,)).fetchone()
     if not user:
-        conn.close()
-        return jsonify({'error': 'User not found'}), 404
+        # Nothing updated: tell "missing" apart from "admin"
+        existing = conn.execute(SQL_GET_USER_ROLE, (user_id,)).fetchone()
+        if not existing:
+            return jsonify({'error': 'User not found'}), 404
 
-    # Don't allow deleting admin
-    if user['role'] == 'admin':
-        conn.close()
+        # Don't allow deleting admin
         return jsonify({'error': 'Cannot delete admin user'}), 403
 
-    # Soft delete (deactivate)
-    conn.execute('UPDATE users SET active = 0 WHERE id = ?', (user_id,))
-    conn.commit()
-
     # Log activity
     log_activity(user_id, 'user_deleted', f'Deactivated user {user["username"]}')
 
-    conn.close()
-
     print(f"✅ User {user['username']} deactivated")
 
     return jsonify({
@@ -344,33 +665,29 @@ def list_actors():
     # Get actors with keys from file system
     actors_with_keys = crypto_manager.list_actors()
 
-    # Get user info from database
+    # Get user info from database, only for the actors that have keys
     conn = get_db()
-    users = conn.execute('''
-        SELECT actor_name, username, role, email, created_at, active
-        FROM users 
-        ORDER BY created_at DESC
-    ''').fetchall()
-    conn.close()
-
-    # Create lookup dictionary
-    user_dict = {user['actor_name']: dict(user) for user in users}
-
-    # Combine information
-    result = []
-    for actor_name in actors_with_keys:
-        user_info = user_dict.get(actor_name, {})
-        result.append({
-            'actor_name': actor_name,
-            'username': user_info.get('username', 'Unknown'),
-            'role': user_info.get('role', 'unknown'),
-            'email': user_info.get('email', ''),
-            'has_keys': True,
-            'active': user_info.get('active', False),
-            'created_at': user_info.get('created_at', '')
-        })
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    user_dict = {}
+    for start in range(0, len(actors_with_keys), SQL_MAX_PARAMS):
+        names = actors_with_keys[start:start + SQL_MAX_PARAMS]
+        placeholders = ', '.join('?' * len(names))
+        rows = cursor.execute(f'''
+            SELECT actor_name, username, role, email, active, created_at
+            FROM users
+            WHERE actor_name IN ({placeholders})
+        ''', names)
+        user_dict.update((row[0], dict(zip(_ACTOR_USER_COLUMNS, row[1:]))) for row in rows)
+
+    # Combine information, overlaying the user record onto the defaults
+    no_user = {}
+    result = [
+        {'actor_name': actor_name, **_DEFAULT_USER, **user_dict.get(actor_name, no_user)}
+        for actor_name in actors_with_keys
+    ]
 
-    return jsonify({
+    return ojson({
         'actors': result,
         'count': len(result)
     })
@@ -380,13 +697,7 @@ def list_actors():
 def list_actors_by_role(role):
     """Get all actors filtered by role"""
     conn = get_db()
-    users = conn.execute('''
-        SELECT actor_name, username, email, created_at
-        FROM users 
-        WHERE role = ? AND active = 1
-        ORDER BY created_at DESC
-    ''', (role.lower(),)).fetchall()
-    conn.close()
+    users = conn.execute(SQL_ACTORS_BY_ROLE, (role.lower(),)).fetchall()
 
     return jsonify({
         'role': role,
@@ -402,46 +713,55 @@ def get_stats():
 
     stats = {}
 
-    # Count by role
-    stats['total_users'] = conn.execute('SELECT COUNT(*) FROM users WHERE active = 1').fetchone()[0]
-    stats['suppliers'] = conn.execute('SELECT COUNT(*) FROM users WHERE role = "supplier" AND active = 1').fetchone()[0]
-    stats['distributors'] = conn.execute('SELECT COUNT(*) FROM users WHERE role = "distributor" AND active = 1').fetchone()[0]
-    stats['retailers'] = conn.execute('SELECT COUNT(*) FROM users WHERE role = "retailer" AND active = 1').fetchone()[0]
+    # Count by role (single pass over users)
+    counts = conn.execute(SQL_USER_COUNTS).fetchone()
+    stats['total_users'], stats['suppliers'], stats['distributors'], stats['retailers'] = counts
 
     # Recent activity
-    recent_activity = conn.execute('''
-        SELECT u.username, a.action, a.timestamp, a.details
-        FROM activity_log a
-        JOIN users u ON a.user_id = u.id
-        ORDER BY a.timestamp DESC
-        LIMIT 10
-    ''').fetchall()
+    recent_activity = conn.execute(SQL_RECENT_ACTIVITY).fetchall()
 
-    stats['recent_activity'] = [dict(activity) for activity in recent_activity]
-
-    conn.close()
+    stats['recent_activity'] = [
+        {**activity, 'timestamp': ns_to_iso(activity['timestamp'])}
+        for activity in map(dict, recent_activity)
+    ]
 
-    return jsonify(stats)
+    return ojson(stats)
 
 
 @app.route('/admin/activity', methods=['GET'])
 def get_activity_log():
-    """Get full activity log"""
+    """
+    Get activity log, newest first
+    Page with ?before=<next_before from the previous page> (integer nanoseconds);
+    an ISO timestamp is accepted as well
+    """
     limit = request.args.get('limit', 50, type=int)
+    before = request.args.get('before')
+
+    if limit < 1:
+        return ojson({'error': f'Invalid limit: {limit}'}, 400)
+
+    before_ns = None
+    if before:
+        try:
+            before_ns = int(before) if before.isdigit() else _iso_to_ns(before)
+        except ValueError:
+            return ojson({'error': f'Invalid before timestamp: {before}'}, 400)
 
     conn = get_db()
-    activities = conn.execute('''
-        SELECT u.username, u.actor_name, a.action, a.timestamp, a.details
-        FROM activity_log a
-        JOIN users u ON a.user_id = u.id
-        ORDER BY a.timestamp DESC
-        LIMIT ?
-    ''', (limit,)).fetchall()
-    conn.close()
+    activities = conn.execute(SQL_ACTIVITY_LOG, (before_ns, before_ns, limit)).fetchall()
 
-    return jsonify({
-        'activities': [dict(activity) for activity in activities],
-        'count': len(activities)
+    result = [
+        {**activity, 'timestamp': ns_to_iso(activity['timestamp'])}
+        for activity in map(dict, activities)
+    ]
+
+    return ojson({
+        'activities': result,
+        'count': len(result),
+        # Raw stored value: an ISO string would drop the sub-microsecond part
+        # and skip rows sharing the last row's microsecond
+        'next_before': activities[-1]['timestamp'] if len(activities) == limit else None
     })
 
 
@@ -462,9 +782,13 @@ def redistribute_all_keys():
                 'results': []
             }), 404
 
+        # Check directories and source keys once for the whole run
+        api_directories = prepare_api_key_directories()
+        key_files = set(os.listdir('./keys'))
+
         results = []
         for actor_name in actors:
-            distribution_result = distribute_keys_to_apis(actor_name)
+            distribution_result = distribute_keys_to_apis(actor_name, api_directories, key_files)
             results.append({
                 'actor': actor_name,
                 'result': distribution_result
@@ -491,6 +815,8 @@ def redistribute_all_keys():
 # ==================== MAIN ====================
 
 if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+
     print("\n" + "="*60)
     print("🔐 ADMIN API STARTING")
     print("="*60)
@@ -530,5 +856,6 @@ if __name__ == '__main__':
     print("   POST /admin/keys/redistribute")
     print("="*60 + "\n")
 
-    # Run Flask app
-    app.run(host='0.0.0.0', port=5500, debug=True)
\ No newline at end of file
+    # Serve with waitress: a pool of worker threads handles requests concurrently
+    from waitress import serve
+    serve(app, host='0.0.0.0', port=5500, threads=8)
\ No newline at end of file
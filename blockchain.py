@@ -1,39 +1,292 @@
 import hashlib
+import itertools
 import json
+import math
+import multiprocessing
+import os
+import queue
 import sqlite3
 import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache
 
+import msgpack
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 
 from crypto_utils import CryptoManager, verify_transaction
 
 lock = threading.Lock()
 
+# hashlib's sha256 is OpenSSL's, which already dispatches to the CPU's SHA
+# extensions (SHA-NI / ARMv8 SHA2) when available. Bound once for the hot loop.
+_sha256 = hashlib.sha256
+
+# Nonces handed to each worker per task when mining in parallel, and how
+# often (in nonces) a worker checks whether the search was already won
+POW_CHUNK_SIZE = 50000
+POW_CANCEL_CHECK = 5000
+
+# Peers contacted concurrently when broadcasting
+BROADCAST_WORKERS = 32
+# Relayed txs a follower keeps (outside its mempool) to rebuild compact blocks
+RELAY_CACHE_SIZE = 5000
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# SQL statements, defined once so sqlite3's statement cache reuses the
+# compiled form for every call (the cache is keyed on the exact SQL text)
+SQL_SELECT_CHAIN = "SELECT block FROM chain ORDER BY idx"
+SQL_SELECT_MEMPOOL = "SELECT tx FROM mempool ORDER BY idx"
+SQL_SELECT_NODES = "SELECT node FROM nodes"
+SQL_INSERT_BLOCK = "INSERT INTO chain (block) VALUES (?)"
+SQL_INSERT_TX = "INSERT INTO mempool (tx) VALUES (?)"
+SQL_INSERT_NODE = "INSERT OR IGNORE INTO nodes (node) VALUES (?)"
+SQL_DELETE_CHAIN = "DELETE FROM chain"
+SQL_DELETE_MEMPOOL = "DELETE FROM mempool"
+SQL_DELETE_NODE = "DELETE FROM nodes WHERE node = ?"
+
+
+def _search_nonces(midstate, tail, difficulty, start, stop=None):
+    """
+    Scan nonces in [start, stop) and return (nonce, hex hash) for the first
+    one meeting difficulty, or None. stop=None scans until found.
+    """
+    # "difficulty" leading hex zeros <=> digest < 16**(64 - difficulty), which
+    # is a single bytes comparison against that bound as 32 big-endian bytes
+    if difficulty > 0:
+        target = (1 << (4 * (64 - difficulty))).to_bytes(32, "big")
+    else:
+        target = b"\xff" * 33  # every 32-byte digest sorts below this
+
+    copy = midstate.copy
+    for nonce in (itertools.count(start) if stop is None else range(start, stop)):
+        h = copy()
+        h.update(b"%d" % nonce)
+        h.update(tail)
+        digest = h.digest()
+        if digest < target:
+            return nonce, digest.hex()
+    return None
+
+
+def _pack(obj):
+    """Encode a block / transaction for storage"""
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+# msgpack (storage) and orjson (peer traffic) only encode 64-bit integers,
+# and orjson writes NaN / Infinity as null, which changes the block hash
+_INT_MIN = -(1 << 63)
+_INT_MAX = (1 << 64) - 1
+
+
+def _storable(value):
+    """Whether a transaction / block can be stored and sent to peers as is"""
+    if isinstance(value, dict):
+        return all(_storable(v) for v in value.values())
+    if isinstance(value, list):
+        return all(_storable(v) for v in value)
+    if isinstance(value, int):
+        return _INT_MIN <= value <= _INT_MAX
+    if isinstance(value, float):
+        return math.isfinite(value)
+    return True
+
+
+def _loads(data):
+    """Parse JSON; files and rows written by the old json.dumps may hold NaN / Infinity"""
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json.loads(data)
+
+
+def _unpack(data):
+    """Decode a stored block / transaction (TEXT rows are from the old JSON format)"""
+    if isinstance(data, str):
+        return _loads(data)
+    return msgpack.unpackb(data, raw=False)
+
+
+# Actor names are "<Role>_<name>"; the prefix decides the role
+_ROLE_PREFIXES = ("supplier", "distributor", "retailer")
+
+
+@lru_cache(maxsize=4096)
+def _actor_role(actor):
+    """Role implied by an actor name's prefix, or None"""
+    actor_lower = actor.lower()
+    for role in _ROLE_PREFIXES:
+        if actor_lower.startswith(role):
+            return role
+    return None
+
+
+# STRICT sequential order - each step requires the EXACT previous step
+_STRICT_SEQUENCE = {
+    'registered': None,  # Step 1: Can always register (no prerequisite)
+    'quality_checked': 'registered',  # Step 2: Must have Step 1
+    'shipped': 'quality_checked',  # Step 3: Must have Step 2
+    'received': 'shipped',  # Step 4: Must have Step 3
+    'stored': 'received',  # Step 5: Must have Step 4
+    'delivered': 'stored',  # Step 6: Must have Step 5
+    'received_retail': 'delivered',  # Step 7: Must have Step 6
+    'sold': 'received_retail'  # Step 8: Must have Step 7
+}
+
+# Required roles for each action
+_ACTOR_ROLES = {
+    "registered": "supplier",
+    "quality_checked": "supplier",
+    "shipped": "supplier",
+    "received": "distributor",
+    "stored": "distributor",
+    "delivered": "distributor",
+    "received_retail": "retailer",
+    "sold": "retailer",
+}
+
+# Actions each role performs as a group (same actor throughout)
+_GROUP_ACTIONS = {
+    "supplier": frozenset({"registered", "quality_checked", "shipped"}),
+    "distributor": frozenset({"received", "stored", "delivered"}),
+    "retailer": frozenset({"received_retail", "sold"})
+}
+
+
+def _tx_sig(tx):
+    """Identity of a transaction for mempool de-duplication"""
+    # A tuple hashes faster than formatting and hashing an f-string
+    return tx["batch_id"], tx["action"], tx.get("timestamp", "")
+
+
+def _unique_txs(txs):
+    """
+    Drop repeats of a transaction, keeping the first. A tx saved by its
+    adder while mine_block re-saves the pending list can be stored twice.
+    """
+    seen = set()
+    unique = []
+    for tx in txs:
+        tx_sig = _tx_sig(tx)
+        if tx_sig not in seen:
+            seen.add(tx_sig)
+            unique.append(tx)
+    return unique
+
+
+# Shared search counter, set in pool processes by _init_pow_worker
+_pow_generation = None
+
+
+def _init_pow_worker(generation):
+    global _pow_generation
+    _pow_generation = generation
+
+
+def _pow_worker(args):
+    """
+    Process-pool entry point: hash objects don't pickle, so rebuild the
+    midstate. Gives up early once the search it belongs to has been won.
+    """
+    head, tail, difficulty, start, stop, generation = args
+    midstate = _sha256(head)
+    for s in range(start, stop, POW_CANCEL_CHECK):
+        if _pow_generation.value != generation:
+            return None
+        found = _search_nonces(midstate, tail, difficulty, s, min(s + POW_CANCEL_CHECK, stop))
+        if found:
+            return found
+    return None
+
 
 # -------------------- BLOCK --------------------
+def _hash_head(index):
+    """Serialized bytes before the nonce ("index" is the only key sorting ahead of it)"""
+    return ('{"index": ' + json.dumps(index) + ', "nonce": ').encode()
+
+
+def _hash_tail_chunks(previous_hash, timestamp, transactions):
+    """Serialized bytes after the nonce, one transaction per chunk"""
+    yield (', "previous_hash": ' + json.dumps(previous_hash)
+           + ', "timestamp": ' + json.dumps(timestamp)
+           + ', "transactions": ').encode()
+    if isinstance(transactions, (list, tuple)):
+        sep = b"["
+        for tx in transactions:
+            yield sep + json.dumps(tx, sort_keys=True).encode()
+            sep = b", "
+        yield b"]}" if sep == b", " else b"[]}"
+    else:
+        yield json.dumps(transactions, sort_keys=True).encode() + b"}"
+
+
+def _hash_block_dict(index, timestamp, transactions, previous_hash, nonce):
+    """
+    SHA-256 hex of json.dumps(block_data, sort_keys=True), streamed into the
+    hash a transaction at a time rather than built in memory first.
+    """
+    h = _sha256(_hash_head(index))
+    h.update(json.dumps(nonce).encode())
+    for chunk in _hash_tail_chunks(previous_hash, timestamp, transactions):
+        h.update(chunk)
+    return h.hexdigest()
+
+
 class Block:
+    __slots__ = ("index", "timestamp", "transactions", "previous_hash", "nonce", "hash", "_hash_parts")
+
     def __init__(self, index, timestamp, transactions, previous_hash, nonce=0, hash=None):
         self.index = index
         self.timestamp = timestamp
         self.transactions = transactions
         self.previous_hash = previous_hash
         self.nonce = nonce
+        # Serialized bytes around the nonce (see pow_parts); only the nonce
+        # and hash change once a block is built, so this is computed once
+        self._hash_parts = None
         self.hash = hash or self.compute_hash()
 
     def compute_hash(self):
-        block_data = {
+        # Same bytes as json.dumps(block_data, sort_keys=True) over
+        # index/timestamp/transactions/previous_hash/nonce
+        if self._hash_parts is not None:
+            head, tail = self._hash_parts
+            h = _sha256(head)
+            h.update(json.dumps(self.nonce).encode())
+            h.update(tail)
+            return h.hexdigest()
+
+        return _hash_block_dict(self.index, self.timestamp, self.transactions,
+                                self.previous_hash, self.nonce)
+
+    def pow_parts(self):
+        """
+        Split the compute_hash() input around the nonce for mining.
+
+        sort_keys puts "nonce" second, so only its digits change between
+        attempts. Returns the (already serialized) bytes before and after it.
+        """
+        if self._hash_parts is None:
+            self._hash_parts = (
+                _hash_head(self.index),
+                b"".join(_hash_tail_chunks(self.previous_hash, self.timestamp, self.transactions))
+            )
+        return self._hash_parts
+
+    def to_dict(self):
+        return {
             "index": self.index,
             "timestamp": self.timestamp,
             "transactions": self.transactions,
             "previous_hash": self.previous_hash,
-            "nonce": self.nonce
+            "nonce": self.nonce,
+            "hash": self.hash
         }
-        block_json = json.dumps(block_data, sort_keys=True).encode()
-        return hashlib.sha256(block_json).hexdigest()
-
-    def to_dict(self):
-        return self.__dict__
 
     @classmethod
     def from_dict(cls, data):
@@ -47,19 +300,48 @@ class Block:
         )
 
 
+# Fixed genesis block, hashed once at import: every node starts from the
+# same block 0, so a fresh node can accept block 1 from any peer
+GENESIS_BLOCK = Block(0, "1970-01-01T00:00:00", [], "0").to_dict()
+
+
 # -------------------- BLOCKCHAIN --------------------
 class Blockchain:
     def __init__(self, port=None, db_file=None, difficulty=2, bootstrap_nodes=None,
-                 enable_crypto=True, max_mempool_size=1000, hostname=None):
+                 enable_crypto=True, max_mempool_size=1000, hostname=None, pow_workers=1):
         self.db_file = db_file
         self.chain = []
         self.mempool = []
+        # Held while a pending tx is persisted and appended, and while
+        # mine_block / accept_block rewrite the stored mempool
+        self._mempool_lock = threading.Lock()
+        # batch_id -> history entries (see get_history), kept in chain order
+        self._batch_index = defaultdict(list)
+        # (batch_id, action, timestamp) of every transaction on the chain
+        self._chain_tx_keys = set()
+        # Mempool indices: batch_id -> pending actions, and all pending tx sigs
+        self._mempool_by_batch = defaultdict(set)
+        self._mempool_sigs = set()
+        # Leading blocks of self.chain already validated, and the hash of the
+        # last of them, so is_chain_valid() only has to check new blocks
+        self._verified_len = 0
+        self._verified_tip = None
+        # Txs relayed to us that we don't hold in our mempool (we are a
+        # follower), by _tx_sig, oldest first; see remember_relayed
+        self._relayed = {}
+        self._relayed_lock = threading.Lock()
         self.nodes = set()
+        # tuple(self.nodes), rebuilt (under _nodes_lock) on every change
+        self._nodes_snapshot = ()
+        self._nodes_lock = threading.Lock()
         self.port = port
         self.hostname = hostname or "localhost"  # Use Docker hostname if provided
         self.difficulty = difficulty
         self.bootstrap_nodes = bootstrap_nodes or []
         self.max_mempool_size = max_mempool_size
+        # Processes used for the nonce search (1 = search in-process)
+        self.pow_workers = max(1, pow_workers or 1)
+        self._pow_pool = None  # created on first parallel search, then reused
 
         # CRITICAL FIX: Add current_metadata for validation
         self.current_metadata = {}
@@ -67,13 +349,23 @@ class Blockchain:
         # NEW: Cryptographic security
         self.enable_crypto = enable_crypto
         self.crypto_manager = CryptoManager() if enable_crypto else None
+        # Signature checks are independent and run in OpenSSL (GIL released)
+        self._verify_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 4) if enable_crypto else None
+
+        # Peer traffic (broadcasts, and the service's sync / registration)
+        # runs in parallel over pooled keep-alive connections
+        self.peer_pool = ThreadPoolExecutor(max_workers=BROADCAST_WORKERS)
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=64, pool_maxsize=64)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
 
         if self.db_file:
             self._init_db()
             self._load_from_db()
         else:
             self.chain_file = f"chain_{port}.json"
-            self.mempool_file = f"mempool_{port}.json"
+            self.mempool_file = f"mempool_{port}.jsonl"
             self.nodes_file = f"nodes_{port}.json"
             self._load_json_files()
 
@@ -82,18 +374,27 @@ class Blockchain:
 
     # -------------------- DB INIT --------------------
     def _init_db(self):
-        with sqlite3.connect(self.db_file) as conn:
-            c = conn.cursor()
+        # One long-lived connection; transactions are managed explicitly
+        self._conn = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None,
+                                     cached_statements=128)
+        self._db_lock = threading.RLock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute("PRAGMA temp_store=MEMORY")
+        self._conn.execute("PRAGMA cache_size=-65536")
+
+        with self._db_transaction() as c:
             c.execute("""
                 CREATE TABLE IF NOT EXISTS chain (
                     idx INTEGER PRIMARY KEY,
-                    block TEXT
+                    block BLOB
                 )
             """)
             c.execute("""
                 CREATE TABLE IF NOT EXISTS mempool (
                     idx INTEGER PRIMARY KEY AUTOINCREMENT,
-                    tx TEXT
+                    tx BLOB
                 )
             """)
             c.execute("""
@@ -101,82 +402,146 @@ class Blockchain:
                     node TEXT PRIMARY KEY
                 )
             """)
-            conn.commit()
 
-    def _load_from_db(self):
-        with sqlite3.connect(self.db_file) as conn:
-            c = conn.cursor()
-            c.execute("SELECT block FROM chain ORDER BY idx")
-            rows = c.fetchall()
-            self.chain = [json.loads(row[0]) for row in rows]
-
-            c.execute("SELECT tx FROM mempool ORDER BY idx")
-            rows = c.fetchall()
-            self.mempool = [json.loads(row[0]) for row in rows]
+    def close(self):
+        """Release the DB connection, worker pools and HTTP session"""
+        if self.db_file:
+            with self._db_lock:
+                self._conn.close()
+        if self._pow_pool is not None:
+            self._pow_pool.terminate()
+            self._pow_pool = None
+        if self._verify_pool is not None:
+            self._verify_pool.shutdown(wait=False)
+        self.peer_pool.shutdown(wait=False)
+        self.http.close()
+
+    @contextmanager
+    def _db_transaction(self):
+        """Run several writes as one transaction (a single fsync)"""
+        with self._db_lock:
+            if self._conn.in_transaction:
+                # Already inside an outer transaction: just join it
+                yield self._conn
+                return
+
+            # IMMEDIATE: take the write lock up front (these are all writes)
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
 
-            c.execute("SELECT node FROM nodes")
-            rows = c.fetchall()
-            self.nodes = set([row[0] for row in rows])
+    def _load_from_db(self):
+        with self._db_lock:
+            c = self._conn.cursor()
+            self.chain = [_unpack(block) for (block,) in c.execute(SQL_SELECT_CHAIN)]
+            self.mempool = _unique_txs(_unpack(tx) for (tx,) in c.execute(SQL_SELECT_MEMPOOL))
+            self.nodes = {node for (node,) in c.execute(SQL_SELECT_NODES)}
+        self._state_replaced()
 
     def _reload_chain_from_db(self):
         """Reload chain from database after replacement"""
         if not self.db_file:
             return
 
-        with sqlite3.connect(self.db_file) as conn:
-            c = conn.cursor()
+        with self._db_lock:
+            c = self._conn.cursor()
 
             # Clear and reload chain
-            c.execute("SELECT block FROM chain ORDER BY idx")
-            rows = c.fetchall()
-            self.chain = [json.loads(row[0]) for row in rows]
+            self.chain = [_unpack(block) for (block,) in c.execute(SQL_SELECT_CHAIN)]
+            self._chain_replaced()
 
             print(f"🔄 Reloaded {len(self.chain)} blocks from database")
 
-    def _save_block_to_db(self, block):
-        with sqlite3.connect(self.db_file) as conn:
-            c = conn.cursor()
-            c.execute("INSERT INTO chain (block) VALUES (?)", (json.dumps(block.to_dict()),))
-            conn.commit()
+    def _save_block_to_db(self, block_dict):
+        with self._db_lock:
+            self._conn.execute(SQL_INSERT_BLOCK, (_pack(block_dict),))
 
     def _save_tx_to_db(self, tx):
-        with sqlite3.connect(self.db_file) as conn:
-            c = conn.cursor()
-            c.execute("INSERT INTO mempool (tx) VALUES (?)", (json.dumps(tx),))
-            conn.commit()
+        with self._db_lock:
+            self._conn.execute(SQL_INSERT_TX, (_pack(tx),))
+
+    def _save_txs_to_db(self, txs):
+        with self._db_lock:
+            self._conn.executemany(SQL_INSERT_TX, ((_pack(tx),) for tx in txs))
 
     def _delete_mempool_db(self):
-        with sqlite3.connect(self.db_file) as conn:
-            c = conn.cursor()
-            c.execute("DELETE FROM mempool")
-            conn.commit()
+        with self._db_lock:
+            self._conn.execute(SQL_DELETE_MEMPOOL)
 
     # -------------------- JSON fallback --------------------
     def _load_json_files(self):
-        import os
         def load(filename, default):
             if os.path.exists(filename):
-                with open(filename, "r") as f:
+                with open(filename, "rb") as f:
                     try:
-                        return json.load(f)
+                        return _loads(f.read())
                     except:
                         return default
             return default
 
         self.chain = load(self.chain_file, [])
-        self.mempool = load(self.mempool_file, [])
+        self.mempool = self._load_mempool_log()
         self.nodes = set(load(self.nodes_file, []))
+        self._state_replaced()
 
     def _save_json(self, filename, data):
+        # stdlib json, like the block hash: a chain loaded from an old file
+        # may still hold NaN / Infinity, which orjson would write as null
         with open(filename, "w") as f:
             json.dump(data, f, indent=4)
 
+    def _load_mempool_log(self):
+        """Read the append-only mempool log (one tx per line)"""
+        if not os.path.exists(self.mempool_file):
+            # Fall back to the old whole-file mempool_{port}.json
+            legacy = self.mempool_file[:-1]
+            if not os.path.exists(legacy):
+                return []
+            with open(legacy, "rb") as f:
+                try:
+                    mempool = _loads(f.read())
+                except:
+                    return []
+
+            # Migrate it into the log once, so later appends don't shadow it
+            self.mempool = mempool
+            self._compact_mempool_log()
+            os.replace(legacy, legacy + ".migrated")
+            return mempool
+
+        mempool = []
+        with open(self.mempool_file, "rb") as f:
+            for line in f:
+                try:
+                    mempool.append(_loads(line))
+                except ValueError:
+                    continue  # blank or torn line from an interrupted write
+        return _unique_txs(mempool)
+
+    def _append_mempool_log(self, txs):
+        with open(self.mempool_file, "ab") as f:
+            f.write(b"".join(orjson.dumps(tx) + b"\n" for tx in txs))
+
+    def _truncate_mempool_log(self):
+        open(self.mempool_file, "wb").close()
+
+    def _compact_mempool_log(self):
+        """Rewrite the log to hold exactly the current mempool (after removals)"""
+        tmp = self.mempool_file + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(b"".join(orjson.dumps(tx) + b"\n" for tx in self.mempool))
+        os.replace(tmp, self.mempool_file)
+
     # -------------------- Genesis --------------------
     def create_genesis_block(self):
-        genesis = Block(0, datetime.utcnow().isoformat(), [], "0")
-        self.chain.append(genesis.to_dict())
+        self.chain.append(dict(GENESIS_BLOCK, transactions=[]))
+        self._index_block(self.chain[-1])
         if self.db_file:
-            self._save_block_to_db(genesis)
+            self._save_block_to_db(self.chain[-1])
         else:
             self._save_json(self.chain_file, self.chain)
 
@@ -191,22 +556,10 @@ class Blockchain:
         """
         # Get existing actions from BLOCKCHAIN
         history = self.get_history(batch_id)
-        existing_actions = [tx['action'] for tx in history]
+        existing_actions = {tx['action'] for tx in history}
 
         # ALSO check MEMPOOL for pending transactions (not yet mined)
-        mempool_actions = [tx['action'] for tx in self.mempool if tx['batch_id'] == batch_id]
-
-        # Define STRICT sequential order - each step requires the EXACT previous step
-        strict_sequence = {
-            'registered': None,  # Step 1: Can always register (no prerequisite)
-            'quality_checked': 'registered',  # Step 2: Must have Step 1
-            'shipped': 'quality_checked',  # Step 3: Must have Step 2
-            'received': 'shipped',  # Step 4: Must have Step 3
-            'stored': 'received',  # Step 5: Must have Step 4
-            'delivered': 'stored',  # Step 6: Must have Step 5
-            'received_retail': 'delivered',  # Step 7: Must have Step 6
-            'sold': 'received_retail'  # Step 8: Must have Step 7
-        }
+        mempool_actions = self._mempool_by_batch.get(batch_id, frozenset())
 
         # CRITICAL FIX: Check for duplicate actions ONLY in blockchain (not mempool)
         # Mempool can be cleared by mining, so checking it can cause race conditions
@@ -218,16 +571,14 @@ class Blockchain:
             return False, f"Action '{action}' is already pending in mempool for batch {batch_id}"
 
         # Validate action is in the allowed sequence
-        if action not in strict_sequence:
+        if action not in _STRICT_SEQUENCE:
             return False, f"Invalid action '{action}'. Not in allowed sequence."
 
         # Check if prerequisite is met (check BOTH blockchain and mempool)
-        required_previous = strict_sequence[action]
-        all_actions = existing_actions + mempool_actions
-
+        required_previous = _STRICT_SEQUENCE[action]
         if required_previous is not None:
             # EXACT previous step MUST exist
-            if required_previous not in all_actions:
+            if required_previous not in existing_actions | mempool_actions:
                 return False, f"Cannot perform '{action}' without first completing '{required_previous}'"
 
         # SUCCESS: All validations passed
@@ -246,27 +597,16 @@ class Blockchain:
 
         history = self.get_history(batch_id)
 
-        # Required roles for each action:
-        actor_roles = {
-            "registered": "supplier",
-            "quality_checked": "supplier",
-            "shipped": "supplier",
-            "received": "distributor",
-            "stored": "distributor",
-            "delivered": "distributor",
-            "received_retail": "retailer",
-            "sold": "retailer",
-        }
-
         # 1 — Unknown action?
-        if action not in actor_roles:
+        if action not in _ACTOR_ROLES:
             return False, f"Unknown action '{action}'"
 
-        expected_role = actor_roles[action]
+        expected_role = _ACTOR_ROLES[action]
 
         # 2 — First action must be "registered"
+        actor_role = _actor_role(actor)
         if action == "registered":
-            if not actor.lower().startswith("supplier"):
+            if actor_role != "supplier":
                 return False, "Only suppliers can register batches"
             return True, "OK"
 
@@ -277,27 +617,16 @@ class Blockchain:
         # 4 — Determine current owner (last actor)
         last_actor = history[-1]["actor"]
 
-        if last_actor.lower().startswith("supplier"):
-            owner_role = "supplier"
-        elif last_actor.lower().startswith("distributor"):
-            owner_role = "distributor"
-        elif last_actor.lower().startswith("retailer"):
-            owner_role = "retailer"
-        else:
+        owner_role = _actor_role(last_actor)
+        if owner_role is None:
             return False, f"Unknown previous actor '{last_actor}'"
 
         # 5 — Role of current action must match actor type
-        if not actor.lower().startswith(expected_role):
+        if actor_role != expected_role:
             return False, f"'{actor}' is not a valid {expected_role} for action '{action}'"
 
         # 6 — SAME-ACTOR restriction inside group stages
-        group_actions = {
-            "supplier": {"registered", "quality_checked", "shipped"},
-            "distributor": {"received", "stored", "delivered"},
-            "retailer": {"received_retail", "sold"}
-        }
-
-        if action in group_actions.get(owner_role, set()):
+        if action in _GROUP_ACTIONS.get(owner_role, frozenset()):
             if actor != last_actor:
                 return False, (
                     f"Ownership violation: '{actor}' cannot perform '{action}'. "
@@ -376,6 +705,45 @@ class Blockchain:
         - If no signature is provided, we will add a server-side timestamp for bookkeeping.
         - Validates transaction order (e.g., can't ship before registering)
         """
+        return self._add_transaction(batch_id, action, actor, metadata, signature, public_key, timestamp)
+
+    def add_transactions_bulk(self, txs):
+        """
+        Add many transactions (dicts keyed like add_transaction's arguments).
+
+        Each one is validated in order exactly as add_transaction would, but
+        the accepted ones are persisted with a single write. Returns the
+        accepted transactions.
+        """
+        accepted = []
+        # No DB transaction is held here: an auto-mine takes the module lock
+        # and then the DB lock, so holding the DB lock first could deadlock
+        for t in txs:
+            tx = self._add_transaction(
+                t["batch_id"], t["action"], t["actor"], t.get("metadata", {}),
+                t.get("signature"), t.get("public_key"), t.get("timestamp"),
+                persist=False
+            )
+            if tx is not None:
+                accepted.append(tx)
+
+        with self._mempool_lock:
+            # An auto-mine along the way may already have put some in a block
+            pending = {id(tx) for tx in self.mempool}
+            unsaved = [tx for tx in accepted if id(tx) in pending]
+            if not unsaved:
+                return accepted
+
+            if self.db_file:
+                with self._db_transaction():
+                    self._save_txs_to_db(unsaved)
+            else:
+                self._append_mempool_log(unsaved)
+
+        return accepted
+
+    def _add_transaction(self, batch_id, action, actor, metadata, signature=None, public_key=None,
+                         timestamp=None, persist=True):
         # Build tx exactly as the client intended (do not add/modify fields before verify)
         tx = {
             "batch_id": batch_id,
@@ -400,6 +768,10 @@ class Blockchain:
         if public_key:
             tx["public_key"] = public_key
 
+        if not _storable(tx):
+            print("❌ Transaction holds a value that can't be stored (integer over 64 bits, NaN or Infinity). Rejecting.")
+            return None
+
         # STEP 1: Validate transaction order (business logic)
         valid, msg = self.validate_transaction_order(batch_id, action, actor)
         if not valid:
@@ -426,115 +798,221 @@ class Blockchain:
             print(f"⚠️  Mempool full ({self.max_mempool_size}). Auto-mining triggered...")
             self.mine_block()
 
-        # STEP 4: Store in mempool
-        self.mempool.append(tx)
-        if self.db_file:
-            self._save_tx_to_db(tx)
-        else:
-            self._save_json(self.mempool_file, self.mempool)
+        # STEP 4: Store in mempool, persisting first so a failed write
+        # leaves nothing in memory that was never saved
+        with self._mempool_lock:
+            if persist:  # add_transactions_bulk writes the whole batch itself
+                if self.db_file:
+                    self._save_tx_to_db(tx)
+                else:
+                    self._append_mempool_log((tx,))
+            self.mempool.append(tx)
+            self._index_mempool_tx(tx)
 
         print(f"✅ Transaction added: {action} for {batch_id} by {actor}")
         return tx
 
     # -------------------- Mining --------------------
     def proof_of_work(self, block):
+        # Serialize the block once; each attempt only hashes the new nonce
+        # digits on a copy of the prefix state, then the fixed tail
+        head, tail = block.pow_parts()
+        if self.pow_workers > 1:
+            nonce, hash_val = self._parallel_proof_of_work(head, tail, block.nonce)
+        else:
+            nonce, hash_val = _search_nonces(_sha256(head), tail, self.difficulty, block.nonce)
+        block.nonce = nonce
+        block.hash = hash_val
+        return hash_val
+
+    def _parallel_proof_of_work(self, head, tail, start):
+        """
+        Hand out consecutive nonce ranges to a process pool, giving the next
+        range to whichever worker finishes first, and return the first
+        solution reported. Bumping the generation counter then makes the
+        remaining workers drop their (now stale) ranges.
+        """
+        if self._pow_pool is None:
+            self._pow_generation = multiprocessing.Value("L", 0)
+            self._pow_pool = multiprocessing.Pool(
+                self.pow_workers, initializer=_init_pow_worker, initargs=(self._pow_generation,)
+            )
+
+        generation = self._pow_generation.value
+        results = queue.Queue()
+
+        def submit(range_start):
+            self._pow_pool.apply_async(
+                _pow_worker,
+                ((head, tail, self.difficulty, range_start, range_start + POW_CHUNK_SIZE, generation),),
+                callback=results.put,
+                error_callback=results.put
+            )
+
+        # Two ranges per worker in flight so nobody idles between hand-outs
+        next_start = start
+        for _ in range(2 * self.pow_workers):
+            submit(next_start)
+            next_start += POW_CHUNK_SIZE
+
         while True:
-            hash_val = block.compute_hash()
-            if hash_val.startswith("0" * self.difficulty):
-                block.hash = hash_val
-                return hash_val
-            block.nonce += 1
+            found = results.get()
+            if isinstance(found, BaseException):
+                raise found
+            if found:
+                with self._pow_generation.get_lock():
+                    self._pow_generation.value += 1
+                return found
+            submit(next_start)
+            next_start += POW_CHUNK_SIZE
 
     def mine_block(self):
         with lock:
             if not self.mempool:
                 return None
 
-            # CRITICAL FIX: Filter out transactions that are already in blockchain
-            valid_mempool = []
-            for tx in self.mempool:
-                batch_id = tx.get("batch_id")
-                action = tx.get("action")
-                timestamp = tx.get("timestamp")
-
-                # Check if already in blockchain
-                history = self.get_history(batch_id)
-                if any(h["action"] == action and h.get("timestamp") == timestamp for h in history):
-                    print(f"🗑️ Removing duplicate from mempool before mining: {action} for {batch_id}")
-                    continue
-
-                valid_mempool.append(tx)
-
-            if not valid_mempool:
+            # Hand the pending list over to the block before anything is
+            # serialized: add_transaction takes no lock, so txs arriving
+            # during PoW or the broadcast go to the fresh list instead of the
+            # one being hashed. The mempool indices keep the taken txs until
+            # the block is in the chain, so they can't be re-added meanwhile.
+            taken, self.mempool = self.mempool, []
+            transactions = taken
+            chain_keys = self._chain_tx_keys
+            if any((tx.get("batch_id"), tx.get("action"), tx.get("timestamp")) in chain_keys
+                   for tx in transactions):
+                # CRITICAL FIX: Filter out transactions that are already in blockchain
+                valid_mempool = []
+                for tx in transactions:
+                    batch_id = tx.get("batch_id")
+                    action = tx.get("action")
+                    timestamp = tx.get("timestamp")
+
+                    # Check if already in blockchain
+                    if (batch_id, action, timestamp) in chain_keys:
+                        print(f"🗑️ Removing duplicate from mempool before mining: {action} for {batch_id}")
+                        continue
+
+                    valid_mempool.append(tx)
+                transactions = valid_mempool
+
+            if not transactions:
                 print("⚠️  No valid transactions to mine (all duplicates)")
+                with self._mempool_lock:
+                    self.mempool = taken + self.mempool
                 return None
 
             last_block = self.chain[-1]
+            mined_at = datetime.utcnow()
             new_block = Block(
                 index=last_block["index"] + 1,
-                timestamp=datetime.utcnow().isoformat(),
-                transactions=valid_mempool,  # Use filtered mempool!
+                timestamp=mined_at.isoformat(),
+                transactions=transactions,
                 previous_hash=last_block["hash"]
             )
             new_block.hash = self.proof_of_work(new_block)
-            self.chain.append(new_block.to_dict())
-            self.broadcast_block(new_block.to_dict())
-
-            if self.db_file:
-                self._save_block_to_db(new_block)
-                self._delete_mempool_db()
-            else:
-                self._save_json(self.chain_file, self.chain)
-                self._save_json(self.mempool_file, [])
+            # One dict serves the chain, the index, the broadcast and the DB
+            block_dict = new_block.to_dict()
+            self.chain.append(block_dict)
+            self._index_block(block_dict, mined_at.timestamp())
+            self.broadcast_block(block_dict)
+
+            # Persist the mempool as it is now: only what arrived while mining
+            with self._mempool_lock:
+                pending = list(self.mempool)
+                if self.db_file:
+                    with self._db_transaction():
+                        self._save_block_to_db(block_dict)
+                        self._delete_mempool_db()
+                        self._save_txs_to_db(pending)
+                else:
+                    self._save_json(self.chain_file, self.chain)
+                    if pending:
+                        self._compact_mempool_log()
+                    else:
+                        self._truncate_mempool_log()
 
-            self.mempool = []
+                self._rebuild_mempool_index()
 
         return new_block
     def replace_chain(self, new_chain):
         """Replace the entire chain with a new one"""
         self.chain = [b.to_dict() if isinstance(b, Block) else b for b in new_chain]
+        self._chain_replaced()
         if self.db_file:
-            import sqlite3
-            with sqlite3.connect(self.db_file) as conn:
-                c = conn.cursor()
-                c.execute("DELETE FROM chain")
-                for b in self.chain:
-                    c.execute("INSERT INTO chain (block) VALUES (?)", (json.dumps(b),))
-                conn.commit()
+            with self._db_transaction() as c:
+                c.execute(SQL_DELETE_CHAIN)
+                c.executemany(SQL_INSERT_BLOCK, ((_pack(b),) for b in self.chain))
 
     def sync_mempool(self, remote_mempool):
         """Merge remote mempool with local"""
+        # Verify new signed txs in parallel before taking the lock
+        signature_ok = {}
+        if self.enable_crypto:
+            candidates = [tx for tx in remote_mempool
+                          if "signature" in tx and _tx_sig(tx) not in self._mempool_sigs]
+            results = self._verify_pool.map(lambda t: verify_transaction(t, self.crypto_manager), candidates)
+            signature_ok = {id(tx): ok for tx, ok in zip(candidates, results)}
+
         with lock:
-            existing_txs = set()
-            for tx in self.mempool:
-                ts = tx.get("timestamp", "")
-                tx_sig = f"{tx['batch_id']}_{tx['action']}_{ts}"
-                existing_txs.add(tx_sig)
+            added = []
+            # Sigs as received (before any server-side timestamp is added)
+            seen = set()
+            stamp = None
 
             for tx in remote_mempool:
-                ts = tx.get("timestamp", "")
-                tx_sig = f"{tx['batch_id']}_{tx['action']}_{ts}"
-                if tx_sig not in existing_txs:
+                tx_sig = _tx_sig(tx)
+                if tx_sig not in self._mempool_sigs and tx_sig not in seen:
+                    if not _storable(tx):
+                        print(f"⚠️  Skipping transaction with a value that can't be stored")
+                        continue
+
                     # Verify signature if crypto enabled
                     if self.enable_crypto and "signature" in tx:
-                        if not verify_transaction(tx, self.crypto_manager):
+                        ok = signature_ok.get(id(tx))
+                        if ok is None:
+                            # Became new after the pre-check (e.g. mempool was mined meanwhile)
+                            ok = verify_transaction(tx, self.crypto_manager)
+                        if not ok:
                             print(f"⚠️  Skipping transaction with invalid signature")
                             continue
 
                     # If unsigned and missing timestamp, stamp it server-side
                     if "signature" not in tx and "timestamp" not in tx:
-                        tx["timestamp"] = datetime.utcnow().isoformat()
+                        if stamp is None:
+                            stamp = datetime.utcnow().isoformat()
+                        tx["timestamp"] = stamp
 
                     self.mempool.append(tx)
-                    if self.db_file:
-                        self._save_tx_to_db(tx)
-                    existing_txs.add(tx_sig)
+                    self._index_mempool_tx(tx)
+                    added.append(tx)
+                    seen.add(tx_sig)
+
+            if self.db_file and added:
+                with self._db_transaction():
+                    self._save_txs_to_db(added)
+            elif added:
+                self._append_mempool_log(added)
 
     # -------------------- Nodes --------------------
     def get_my_address(self):
         """Return this node's address"""
         return f"http://{self.hostname}:{self.port}"
 
+    @property
+    def nodes_snapshot(self):
+        """
+        Known nodes as a tuple, shared by all readers until the set changes.
+
+        Safe to iterate while other threads add or remove nodes; every
+        change replaces it with a new tuple.
+        """
+        return self._nodes_snapshot
+
+    def _nodes_changed(self):
+        """Rebuild nodes_snapshot (caller holds _nodes_lock)"""
+        self._nodes_snapshot = tuple(self.nodes)
+
     def add_node(self, address):
         """Add a node to the network - CRITICAL: Don't add ourselves"""
         my_address = self.get_my_address()
@@ -542,56 +1020,62 @@ class Blockchain:
             print(f"⚠️  Skipping self-addition: {address}")
             return
 
-        self.nodes.add(address)
+        with self._nodes_lock:
+            self.nodes.add(address)
+            self._nodes_changed()
         if self.db_file:
-            with sqlite3.connect(self.db_file) as conn:
-                c = conn.cursor()
-                c.execute("INSERT OR IGNORE INTO nodes (node) VALUES (?)", (address,))
-                conn.commit()
+            with self._db_lock:
+                self._conn.execute(SQL_INSERT_NODE, (address,))
         else:
             self._save_json(self.nodes_file, list(self.nodes))
 
     def remove_node(self, address):
         """Remove a dead node"""
-        if address in self.nodes:
+        with self._nodes_lock:
+            if address not in self.nodes:
+                return
             self.nodes.remove(address)
-            if self.db_file:
-                with sqlite3.connect(self.db_file) as conn:
-                    c = conn.cursor()
-                    c.execute("DELETE FROM nodes WHERE node = ?", (address,))
-                    conn.commit()
-            else:
-                self._save_json(self.nodes_file, list(self.nodes))
+            self._nodes_changed()
+        if self.db_file:
+            with self._db_lock:
+                self._conn.execute(SQL_DELETE_NODE, (address,))
+        else:
+            self._save_json(self.nodes_file, list(self.nodes))
 
     # -------------------- Verification --------------------
     def is_chain_valid(self, chain=None):
         """Validate blockchain integrity"""
         chain_to_check = chain if chain else self.chain
+        own_chain = chain_to_check is self.chain
+        length = len(chain_to_check)
 
-        if len(chain_to_check) == 0:
+        if length == 0:
             return True, "Empty chain"
 
-        for i in range(1, len(chain_to_check)):
+        # Our own chain only grows by appends between replacements: skip the
+        # prefix validated last time, as long as its tip is still in place
+        start = 1
+        if (own_chain and 1 < self._verified_len <= length
+                and chain_to_check[self._verified_len - 1]["hash"] == self._verified_tip):
+            start = self._verified_len
+
+        for i in range(start, length):
             prev = chain_to_check[i - 1]
             curr = chain_to_check[i]
 
-            # Reconstruct block to verify hash
-            block_obj = Block(
-                curr["index"],
-                curr["timestamp"],
-                curr["transactions"],
-                curr["previous_hash"],
-                curr["nonce"]
-            )
-
             # Check previous hash linkage
             if curr["previous_hash"] != prev["hash"]:
                 return False, f"Invalid previous_hash at block {i}"
 
             # Check block hash
-            if block_obj.compute_hash() != curr["hash"]:
+            if _hash_block_dict(curr["index"], curr["timestamp"], curr["transactions"],
+                                curr["previous_hash"], curr["nonce"]) != curr["hash"]:
                 return False, f"Invalid block hash at block {i}"
 
+        if own_chain:
+            self._verified_len = length
+            self._verified_tip = chain_to_check[length - 1]["hash"]
+
         return True, "Chain is valid"
 
     # -------------------- Actor Management --------------------
@@ -610,44 +1094,175 @@ class Blockchain:
         return self.crypto_manager.list_actors()
 
     # -------------------- Batch History --------------------
-    def get_history(self, batch_id):
-        """Get complete history for a batch"""
-        history = []
+    def _index_block(self, block, block_timestamp=None):
+        """Add a block's transactions to the batch_id index"""
+        if block_timestamp is None:
+            block_timestamp = datetime.fromisoformat(block["timestamp"]).timestamp()
+        for tx in block["transactions"]:
+            tx_copy = tx.copy()
+            tx_copy["block_timestamp"] = block_timestamp
+
+            # Mark signature status
+            if self.enable_crypto and "signature" in tx_copy:
+                tx_copy["signature_valid"] = True
+                tx_copy["has_signature"] = True
+            else:
+                tx_copy["signature_valid"] = None
+                tx_copy["has_signature"] = False
+
+            self._batch_index[tx["batch_id"]].append(tx_copy)
+            self._chain_tx_keys.add((tx["batch_id"], tx["action"], tx.get("timestamp")))
+
+    def _chain_replaced(self):
+        """Re-derive everything cached from self.chain after it was swapped out"""
+        self._rebuild_batch_index()
+        self._verified_len = 0
+        self._verified_tip = None
+
+    def _state_replaced(self):
+        """Same, after chain, mempool and nodes were all (re)loaded"""
+        self._chain_replaced()
+        self._rebuild_mempool_index()
+        with self._nodes_lock:
+            self._nodes_changed()
+
+    def _rebuild_batch_index(self):
+        """Re-index the whole chain (after load / replacement)"""
+        self._batch_index = defaultdict(list)
+        self._chain_tx_keys = set()
         for block in self.chain:
-            for tx in block["transactions"]:
-                if tx["batch_id"] == batch_id:
-                    tx_copy = tx.copy()
-                    tx_copy["block_timestamp"] = datetime.fromisoformat(block["timestamp"]).timestamp()
-
-                    # Mark signature status
-                    if self.enable_crypto and "signature" in tx_copy:
-                        tx_copy["signature_valid"] = True
-                        tx_copy["has_signature"] = True
-                    else:
-                        tx_copy["signature_valid"] = None
-                        tx_copy["has_signature"] = False
+            self._index_block(block)
+
+    def _index_mempool_tx(self, tx):
+        """Add a pending transaction to the mempool indices"""
+        self._mempool_by_batch[tx["batch_id"]].add(tx["action"])
+        self._mempool_sigs.add(_tx_sig(tx))
+
+    def _rebuild_mempool_index(self):
+        """Re-index the mempool (after load / mining / block acceptance)"""
+        self._mempool_by_batch = defaultdict(set)
+        self._mempool_sigs = set()
+        for tx in self.mempool:
+            self._index_mempool_tx(tx)
+
+    def get_history(self, batch_id):
+        """
+        Get complete history for a batch.
+
+        Returns the indexed list itself (entries are built once per block),
+        so callers must treat it as read-only.
+        """
+        return self._batch_index.get(batch_id, [])
+
+    def is_on_chain(self, batch_id, action, timestamp):
+        """Whether this exact transaction is already in a block"""
+        return (batch_id, action, timestamp) in self._chain_tx_keys
+
+    def is_pending(self, batch_id, action, timestamp):
+        """Whether this exact transaction is already in the mempool"""
+        return (batch_id, action, "" if timestamp is None else timestamp) in self._mempool_sigs
+
+    def mempool_ids(self):
+        """Ids of all pending transactions, to send to a peer's /mempool/diff"""
+        return list(self._mempool_sigs)
+
+    def mempool_diff(self, have_ids):
+        """Pending transactions whose id is not among have_ids (see mempool_ids)"""
+        have = {tuple(tx_id) for tx_id in have_ids}
+        return [tx for tx in self.mempool if _tx_sig(tx) not in have]
 
-                    history.append(tx_copy)
-        return history
+    def post_to_peers(self, path, payload, what, nodes=None, fallback=None):
+        """
+        POST payload to nodes (default: every known node) concurrently;
+        returns once all have answered or timed out.
+
+        fallback: (path, payload) sent instead to a peer that answers 404,
+        i.e. an older node without this endpoint.
+        """
+        # Serialize once for all peers rather than per request
+        body = orjson.dumps(payload)
+        fallback_body = orjson.dumps(fallback[1]) if fallback else None
+
+        def post(node):
+            try:
+                r = self.http.post(f"{node}{path}", data=body, headers=JSON_HEADERS, timeout=3)
+                if fallback and r.status_code == 404:
+                    self.http.post(f"{node}{fallback[0]}", data=fallback_body, headers=JSON_HEADERS, timeout=3)
+            except Exception as e:
+                print(f"⚠️ Failed to broadcast {what} to {node}: {e}")
+
+        list(self.peer_pool.map(post, self.nodes_snapshot if nodes is None else nodes))
 
     def broadcast_transaction(self, tx):
         """Broadcast a single transaction to all nodes"""
-        for node in list(self.nodes):
-            try:
-                requests.post(f"{node}/receive-transaction", json=tx, timeout=3)
-            except:
-                print(f"⚠️ Failed to broadcast transaction to {node}")
+        self.post_to_peers("/receive-transaction", tx, "transaction")
+
+    def broadcast_block(self, block_dict, nodes=None):
+        """Broadcast newly mined block to all nodes (default) or to nodes"""
+        # Peers normally hold its txs already (pending, or relayed to a
+        # follower), so send ids instead of bodies; nodes predating compact
+        # blocks get the full block on /receive-block
+        self.post_to_peers("/receive-compact-block", self.compact_block(block_dict), "block",
+                           nodes, fallback=("/receive-block", block_dict))
+
+    def compact_block(self, block_dict):
+        """Block header plus the ids of its transactions (see expand_compact_block)"""
+        compact = {k: v for k, v in block_dict.items() if k != "transactions"}
+        compact["tx_ids"] = [_tx_sig(tx) for tx in block_dict["transactions"]]
+        compact["sender"] = self.get_my_address()
+        return compact
+
+    def remember_relayed(self, txs):
+        """
+        Keep txs relayed to us that we don't add to our mempool (followers
+        wait for the block), so a compact block holding them can be rebuilt
+        """
+        with self._relayed_lock:
+            for tx in txs:
+                if "batch_id" in tx and "action" in tx:
+                    self._relayed[_tx_sig(tx)] = tx
+            while len(self._relayed) > RELAY_CACHE_SIZE:
+                del self._relayed[next(iter(self._relayed))]
+
+    def expand_compact_block(self, compact):
+        """
+        Rebuild a full block from a compact announcement using our mempool
+        and the txs relayed to us.
 
-    def broadcast_block(self, block_dict):
-        """Broadcast newly mined block to all nodes"""
-        for node in list(self.nodes):
-            try:
-                requests.post(f"{node}/receive-block", json=block_dict, timeout=3)
-            except:
-                print(f"⚠️ Failed to broadcast block to {node}")
+        Returns None if one of its txs is not known here, or the rebuilt
+        block does not hash to the announced hash; the caller should then
+        fetch the whole block from the sender.
+        """
+        pending = {_tx_sig(tx): tx for tx in self.mempool}
+        relayed = self._relayed
+        transactions = []
+        for tx_id in compact["tx_ids"]:
+            tx_id = tuple(tx_id)
+            tx = pending.get(tx_id) or relayed.get(tx_id)
+            if tx is None:
+                return None
+            transactions.append(tx)
 
-    def accept_block(self, block_dict):
-        """Accept an incoming block from another node"""
+        if _hash_block_dict(compact["index"], compact["timestamp"], transactions,
+                            compact["previous_hash"], compact["nonce"]) != compact["hash"]:
+            return None
+
+        return {
+            "index": compact["index"],
+            "timestamp": compact["timestamp"],
+            "transactions": transactions,
+            "previous_hash": compact["previous_hash"],
+            "nonce": compact["nonce"],
+            "hash": compact["hash"]
+        }
+
+    def accept_block(self, block_dict, hash_verified=False):
+        """
+        Accept an incoming block from another node.
+
+        hash_verified: the caller already re-hashed the block (e.g. before
+        taking its lock), so the PoW hash check is skipped here.
+        """
         new_block = Block.from_dict(block_dict)
 
         # Validate previous hash matches
@@ -656,48 +1271,64 @@ class Blockchain:
             return False, "Previous hash mismatch"
 
         # Validate PoW hash
-        if new_block.compute_hash() != new_block.hash:
+        if not hash_verified and new_block.compute_hash() != new_block.hash:
             return False, "Invalid block hash"
 
+        if not _storable(new_block.transactions):
+            return False, "Block holds a value that can't be stored"
+
         # ========== ADD THIS: Check for duplicate transactions ==========
+        block_keys = set()
         for tx in new_block.transactions:
             batch_id = tx.get("batch_id")
             action = tx.get("action")
             timestamp = tx.get("timestamp")
 
-            # Check if this EXACT transaction already exists in blockchain
-            history = self.get_history(batch_id)
-            if any(h["action"] == action and h.get("timestamp") == timestamp for h in history):
+            # Check if this EXACT transaction already exists in blockchain (or earlier in this block)
+            key = (batch_id, action, timestamp)
+            if key in self._chain_tx_keys or key in block_keys:
                 print(f"⚠️  Rejecting block with duplicate transaction: {action} for {batch_id}")
                 return False, f"Block contains duplicate transaction: {action} for {batch_id}"
+            block_keys.add(key)
         # ========== END ADD ==========
         # Append
         self.chain.append(new_block.to_dict())
+        self._index_block(self.chain[-1])
 
         # CRITICAL FIX: Only remove transactions that were INCLUDED in this block
         # Keep other pending transactions in mempool
-        mined_transactions = set()
-        for tx in new_block.transactions:
-            tx_sig = f"{tx['batch_id']}_{tx['action']}_{tx.get('timestamp', '')}"
-            mined_transactions.add(tx_sig)
+        mined_transactions = {_tx_sig(tx) for tx in new_block.transactions}
 
-        # Filter mempool to keep only transactions NOT in this block
-        new_mempool = []
-        for tx in self.mempool:
-            tx_sig = f"{tx['batch_id']}_{tx['action']}_{tx.get('timestamp', '')}"
-            if tx_sig not in mined_transactions:
-                new_mempool.append(tx)
-            else:
-                print(f"🗑️ Removing mined transaction from mempool: {tx['action']} for {tx['batch_id']}")
+        if self._relayed:
+            with self._relayed_lock:
+                for tx_sig in mined_transactions:
+                    self._relayed.pop(tx_sig, None)
 
-        self.mempool = new_mempool
+        # Nothing pending was mined (e.g. we are a follower): mempool unchanged
+        if mined_transactions.isdisjoint(self._mempool_sigs):
+            print(f"✅ Block accepted. Mempool now has {len(self.mempool)} pending transactions")
+            return True, "Block accepted"
 
-        # Update database if using DB
-        if self.db_file:
-            # Clear and re-save mempool
-            self._delete_mempool_db()
+        with self._mempool_lock:
+            # Filter mempool to keep only transactions NOT in this block
+            new_mempool = []
             for tx in self.mempool:
-                self._save_tx_to_db(tx)
+                if _tx_sig(tx) not in mined_transactions:
+                    new_mempool.append(tx)
+                else:
+                    print(f"🗑️ Removing mined transaction from mempool: {tx['action']} for {tx['batch_id']}")
+
+            self.mempool = new_mempool
+            self._rebuild_mempool_index()
+
+            # Update database if using DB
+            if self.db_file:
+                # Clear and re-save mempool in one transaction
+                with self._db_transaction():
+                    self._delete_mempool_db()
+                    self._save_txs_to_db(self.mempool)
+            else:
+                self._compact_mempool_log()
 
         print(f"✅ Block accepted. Mempool now has {len(self.mempool)} pending transactions")
 
@@ -708,7 +1339,7 @@ class Blockchain:
         my_len = len(self.chain)
         best_chain = self.chain
 
-        for node in list(self.nodes):
+        for node in self.nodes_snapshot:
             try:
                 r = requests.get(f"{node}/chain", timeout=3)
                 remote = r.json().get("chain", [])
@@ -1,12 +1,15 @@
 import argparse
+import json
+import queue
 import threading
 import requests
 import time
-from flask import Flask, jsonify, request
+import orjson
+from flask import Flask, Response, jsonify, request, stream_with_context
 from flask_cors import CORS
 from election import detect_master
 
-from blockchain import Blockchain, Block
+from blockchain import Blockchain, Block, JSON_HEADERS
 from crypto_utils import create_signed_transaction
 import datetime
 import sys
@@ -20,6 +23,14 @@ lock = threading.Lock()
 blockchain = None
 PORT = None
 node_ready = False  # CRITICAL: Track if node is ready to accept transactions
+SYNC_INTERVAL = 30  # seconds between syncs when nothing asks for one sooner
+SYNC_EVERY_N_BLOCKS = 10  # also sync after every Nth accepted block
+sync_event = threading.Event()  # set to wake periodic_consensus early
+
+# Outgoing broadcasts: queued by request handlers, sent by one worker thread
+# through the blockchain's peer pool and keep-alive session
+_broadcast_q = queue.Queue()
+BROADCAST_BATCH_DELAY = 0.05  # seconds a queued tx waits for others to share its POST
 
 
 # ------------------ UTILITIES ------------------
@@ -33,20 +44,97 @@ def get_my_address():
 
 
 def broadcast(endpoint, data, exclude_self=True):
-    """Broadcast data to all known nodes"""
+    """Broadcast data to all known nodes (sent in the background)"""
+    _broadcast_q.put((endpoint, data, exclude_self))
 
-    def task():
-        my_address = get_my_address()
-        for node in list(blockchain.nodes):
-            if exclude_self and node == my_address:
-                continue
+
+def send_to_peers(endpoint, data, exclude_self=True):
+    """POST data to all known nodes at once; returns when all have answered"""
+    my_address = get_my_address()
+    nodes = [node for node in blockchain.nodes_snapshot if not (exclude_self and node == my_address)]
+    if endpoint == "/receive-block":
+        # Announced as a compact block, with /receive-block for older nodes
+        blockchain.broadcast_block(data, nodes)
+    else:
+        blockchain.post_to_peers(endpoint, data, endpoint, nodes)
+
+
+def broadcast_worker():
+    """
+    Send queued broadcasts in order.
+
+    Consecutive transactions are coalesced into one /receive-transactions
+    POST per peer instead of one POST per transaction.
+    """
+    while True:
+        item = _broadcast_q.get()
+        if item[0] == "/receive-transaction":
+            time.sleep(BROADCAST_BATCH_DELAY)
+        items = [item]
+        while True:
+            try:
+                items.append(_broadcast_q.get_nowait())
+            except queue.Empty:
+                break
+
+        txs, txs_exclude_self = [], True
+
+        def send(endpoint, data, exclude_self):
+            # One bad payload must not stop this (the only) broadcast thread
             try:
-                requests.post(f"{node}{endpoint}", json=data, timeout=3)
-                print(f"✅ Broadcasted to {node}{endpoint}")
+                send_to_peers(endpoint, data, exclude_self)
+                return True
             except Exception as e:
-                print(f"❌ Failed to broadcast to {node}: {e}")
+                print(f"❌ Failed to broadcast {endpoint}: {e}")
+                return False
+
+        def flush_txs():
+            if len(txs) > 1:
+                if not send("/receive-transactions", {"txs": txs}, txs_exclude_self):
+                    # Send them one by one so only the bad one is lost
+                    for tx in txs:
+                        send("/receive-transaction", tx, txs_exclude_self)
+            elif txs:
+                send("/receive-transaction", txs[0], txs_exclude_self)
+            txs.clear()
+
+        for endpoint, data, exclude_self in items:
+            if endpoint == "/receive-transaction":
+                if txs and exclude_self != txs_exclude_self:
+                    flush_txs()
+                txs_exclude_self = exclude_self
+                txs.append(data)
+            else:
+                flush_txs()
+                send(endpoint, data, exclude_self)
+        flush_txs()
+
+
+def fetch_peer_state(node, have_ids):
+    """
+    Fetch a peer's chain, the pending txs it has that we don't (have_ids
+    are the ids of ours), and its node list.
 
-    threading.Thread(target=task, daemon=True).start()
+    Returns (node, state, error): state holds whatever was fetched before
+    the first failure, error is that exception (or None).
+    """
+    state = {}
+    try:
+        r = blockchain.http.get(f"{node}/chain", timeout=3)
+        if r.status_code == 200:
+            state["chain"] = r.json()["chain"]
+
+        r = blockchain.http.post(f"{node}/mempool/diff", data=orjson.dumps({"have": have_ids}),
+                                 headers=JSON_HEADERS, timeout=3)
+        if r.status_code == 200:
+            state["mempool"] = r.json().get("mempool", [])
+
+        r = blockchain.http.get(f"{node}/nodes", timeout=3)
+        if r.status_code == 200:
+            state["nodes"] = r.json().get("nodes", [])
+    except Exception as e:
+        return node, state, e
+    return node, state, None
 
 
 def sync_with_network():
@@ -68,66 +156,57 @@ def sync_with_network():
         longest_chain = blockchain.chain
         best_chain_valid = current_valid
         chain_replaced = False
-        max_mempool = blockchain.mempool.copy()
-
-        for node in list(blockchain.nodes):
-            if node == my_address:
-                continue
-
-            try:
-                # --- Sync chain ---
-                r = requests.get(f"{node}/chain", timeout=3)
-                if r.status_code == 200:
-                    data = r.json()
-                    remote_chain = data["chain"]
-                    valid_remote, _ = blockchain.is_chain_valid(remote_chain)
-
-                    # IMPROVED REPLACEMENT LOGIC:
-                    # Replace if ANY of these conditions:
-                    # (1) Our chain is invalid AND theirs is valid
-                    # (2) Both valid, theirs is longer
-                    # (3) Both same length, but ours is invalid and theirs is valid
-                    should_replace = False
-
-                    if not current_valid and valid_remote:
-                        # We're broken, they're good
-                        should_replace = True
-                        print(f"🔧 Found valid replacement chain at {node}")
-                    elif current_valid and valid_remote and len(remote_chain) > len(longest_chain):
-                        # Both good, theirs is longer
-                        should_replace = True
-                        print(f"📥 Found longer valid chain at {node}")
-                    elif not current_valid and not valid_remote:
-                        # Both broken, skip
-                        print(f"⚠️  Node {node} also has invalid chain")
-                        continue
-
-                    if should_replace:
-                        longest_chain = remote_chain
-                        best_chain_valid = valid_remote
-                        chain_replaced = True
-
-                # --- Sync mempool ---
-                r = requests.get(f"{node}/mempool", timeout=3)
-                if r.status_code == 200:
-                    remote_mempool = r.json().get("mempool", [])
-                    if len(remote_mempool) > len(max_mempool):
-                        max_mempool = remote_mempool
-                        print(f"📥 Found larger mempool at {node}")
-
-                # --- Sync node list ---
-                r = requests.get(f"{node}/nodes", timeout=3)
-                if r.status_code == 200:
-                    remote_nodes = r.json().get("nodes", [])
-                    for remote_node in remote_nodes:
-                        if remote_node == my_address:
-                            continue
-                        if remote_node not in blockchain.nodes:
-                            blockchain.add_node(remote_node)
-                            print(f"🆕 Discovered new node: {remote_node}")
-
-            except Exception as e:
-                print(f"⚠️  Node {node} appears to be down: {e}")
+        missing_txs = []
+
+        # Query every peer at once; results are then applied in node order
+        peers = [node for node in blockchain.nodes_snapshot if node != my_address]
+        have_ids = blockchain.mempool_ids()
+        for node, state, error in blockchain.peer_pool.map(lambda node: fetch_peer_state(node, have_ids), peers):
+            # --- Sync chain ---
+            if "chain" in state:
+                remote_chain = state["chain"]
+                valid_remote, _ = blockchain.is_chain_valid(remote_chain)
+
+                # IMPROVED REPLACEMENT LOGIC:
+                # Replace if ANY of these conditions:
+                # (1) Our chain is invalid AND theirs is valid
+                # (2) Both valid, theirs is longer
+                # (3) Both same length, but ours is invalid and theirs is valid
+                should_replace = False
+
+                if not current_valid and valid_remote:
+                    # We're broken, they're good
+                    should_replace = True
+                    print(f"🔧 Found valid replacement chain at {node}")
+                elif current_valid and valid_remote and len(remote_chain) > len(longest_chain):
+                    # Both good, theirs is longer
+                    should_replace = True
+                    print(f"📥 Found longer valid chain at {node}")
+                elif not current_valid and not valid_remote:
+                    # Both broken, skip
+                    print(f"⚠️  Node {node} also has invalid chain")
+                    continue
+
+                if should_replace:
+                    longest_chain = remote_chain
+                    best_chain_valid = valid_remote
+                    chain_replaced = True
+
+            # --- Sync mempool: peers only send what we lack ---
+            if state.get("mempool"):
+                missing_txs.extend(state["mempool"])
+                print(f"📥 Found {len(state['mempool'])} pending transactions we lack at {node}")
+
+            # --- Sync node list ---
+            for remote_node in state.get("nodes", []):
+                if remote_node == my_address:
+                    continue
+                if remote_node not in blockchain.nodes:
+                    blockchain.add_node(remote_node)
+                    print(f"🆕 Discovered new node: {remote_node}")
+
+            if error is not None:
+                print(f"⚠️  Node {node} appears to be down: {error}")
 
         # Apply replacement if found a better chain
         if chain_replaced and longest_chain != blockchain.chain:
@@ -138,9 +217,9 @@ def sync_with_network():
             if blockchain.db_file:
                 blockchain._reload_chain_from_db()
 
-        # Sync mempool if needed
-        if len(max_mempool) > len(blockchain.mempool):
-            blockchain.sync_mempool(max_mempool)
+        # Sync mempool if needed (sync_mempool drops txs several peers sent)
+        if missing_txs:
+            blockchain.sync_mempool(missing_txs)
             print("✅ Mempool synced from network")
 
         print(f"✅ Sync complete. Chain: {len(blockchain.chain)}, "
@@ -156,34 +235,42 @@ def register_with_bootstrap_nodes():
     my_address = get_my_address()
     print(f"\n🚀 Registering with network as {my_address}")
 
-    for peer in blockchain.bootstrap_nodes:
-        if peer == my_address:
-            continue
-
+    def register(peer):
+        # Network only; results are applied below, one peer at a time
         try:
-            response = requests.post(
+            response = blockchain.http.post(
                 f"{peer}/nodes/register",
                 json={"node_url": my_address},
                 timeout=5
             )
-            if response.status_code in [200, 201]:
-                print(f"✅ Registered with {peer}")
-                blockchain.add_node(peer)
-
-                r = requests.get(f"{peer}/nodes", timeout=3)
-                if r.status_code == 200:
-                    their_nodes = r.json().get("nodes", [])
-                    for node in their_nodes:
-                        if node == my_address:
-                            continue
-                        if node not in blockchain.nodes:
-                            blockchain.add_node(node)
-                            print(f"🔍 Discovered peer: {node}")
-            else:
-                print(f"⚠️  Registration failed with {peer}: {response.status_code}")
-
+            if response.status_code not in [200, 201]:
+                return peer, response.status_code, None, None
+
+            their_nodes = None
+            r = blockchain.http.get(f"{peer}/nodes", timeout=3)
+            if r.status_code == 200:
+                their_nodes = r.json().get("nodes", [])
+            return peer, response.status_code, their_nodes, None
         except Exception as e:
-            print(f"❌ Could not register with {peer}: {e}")
+            return peer, None, None, e
+
+    peers = [peer for peer in blockchain.bootstrap_nodes if peer != my_address]
+    for peer, status, their_nodes, error in blockchain.peer_pool.map(register, peers):
+        if error is not None:
+            print(f"❌ Could not register with {peer}: {error}")
+            continue
+        if status not in [200, 201]:
+            print(f"⚠️  Registration failed with {peer}: {status}")
+            continue
+
+        print(f"✅ Registered with {peer}")
+        blockchain.add_node(peer)
+        for node in their_nodes or []:
+            if node == my_address:
+                continue
+            if node not in blockchain.nodes:
+                blockchain.add_node(node)
+                print(f"🔍 Discovered peer: {node}")
 
     print("\n🔄 Performing initial sync...")
     sync_with_network()
@@ -222,7 +309,7 @@ def add_transaction():
             tx_data = request.get_json()
             print(f"🔄 Forwarding transaction: {tx_data.get('action')} for {tx_data.get('batch_id')}")
 
-            response = requests.post(
+            response = blockchain.http.post(
                 f"http://{master}:5000/add-transaction",
                 json=tx_data,
                 timeout=5
@@ -315,7 +402,8 @@ def add_transaction():
     print(f"✅ Transaction added to mempool: {action} for {batch_id}")
     print(f"📢 Broadcasting to network...")
 
-    broadcast("/receive-transaction", tx_data)
+    # The stored tx (with any server timestamp), so peers can match it by id
+    broadcast("/receive-transaction", result)
 
     return jsonify({"message": "Transaction added"}), 201
 
@@ -330,19 +418,19 @@ def receive_transaction():
     timestamp = tx_data.get("timestamp")
 
     # Check if already in blockchain
-    history = blockchain.get_history(batch_id)
-    if any(tx["action"] == action and tx.get("timestamp") == timestamp for tx in history):
+    if blockchain.is_on_chain(batch_id, action, timestamp):
         print(f"ℹ️ Transaction already in blockchain, skipping: {action} for {batch_id}")
         return jsonify({"message": "Transaction already exists"}), 200
 
     # Check if already in mempool
-    if any(tx["batch_id"] == batch_id and tx["action"] == action and tx.get("timestamp") == timestamp
-           for tx in blockchain.mempool):
+    if blockchain.is_pending(batch_id, action, timestamp):
         print(f"ℹ️ Transaction already in mempool, skipping: {action} for {batch_id}")
         return jsonify({"message": "Transaction already pending"}), 200
 
     # CRITICAL FIX: Followers DON'T add to mempool, they wait for the block
     if blockchain.hostname != master:
+        # ...but keep it aside, to rebuild the compact block announcing it
+        blockchain.remember_relayed([tx_data])
         print(f"ℹ️ Follower {blockchain.hostname} acknowledged transaction (waiting for block)")
         return jsonify({"message": "Transaction acknowledged by follower"}), 200
 
@@ -367,6 +455,31 @@ def receive_transaction():
     return jsonify({"message": "Transaction received"}), 200
 
 
+@app.route("/receive-transactions", methods=["POST"])
+def receive_transactions():
+    """Bulk form of /receive-transaction (see broadcast_worker)"""
+    master = detect_master(blockchain.hostname, len(blockchain.chain))
+    txs = request.get_json().get("txs", [])
+
+    # Skip anything already mined or pending here
+    new_txs = [tx for tx in txs
+               if not blockchain.is_on_chain(tx.get("batch_id"), tx.get("action"), tx.get("timestamp"))
+               and not blockchain.is_pending(tx.get("batch_id"), tx.get("action"), tx.get("timestamp"))]
+
+    # CRITICAL FIX: Followers DON'T add to mempool, they wait for the block
+    if blockchain.hostname != master:
+        # ...but keep them aside, to rebuild the compact block announcing them
+        blockchain.remember_relayed(new_txs)
+        print(f"ℹ️ Follower {blockchain.hostname} acknowledged {len(txs)} transactions (waiting for block)")
+        return jsonify({"message": "Transactions acknowledged by follower"}), 200
+
+    # Only master adds to mempool, all in one write
+    accepted = blockchain.add_transactions_bulk(new_txs)
+
+    print(f"✅ Master added {len(accepted)} of {len(txs)} replicated transactions to mempool")
+    return jsonify({"message": "Transactions received", "accepted": len(accepted)}), 200
+
+
 @app.route("/mine", methods=["POST"])
 def mine_block():
     master = detect_master(blockchain.hostname, len(blockchain.chain))
@@ -383,21 +496,73 @@ def mine_block():
 
 @app.route("/receive-block", methods=["POST"])
 def receive_block():
+    return accept_incoming_block(request.get_json())
+
+
+@app.route("/receive-compact-block", methods=["POST"])
+def receive_compact_block():
+    """Accept a block announced as header + tx ids, rebuilt from our mempool"""
     data = request.get_json()
+    block_dict = blockchain.expand_compact_block(data)
+
+    if block_dict is None:
+        # Some of its txs never reached us: fetch the full block instead.
+        # Only known peers are asked (the sender first, if it is one), so a
+        # request body can't point this node at an arbitrary host.
+        peers = blockchain.nodes_snapshot
+        sender = data.get("sender")
+        sources = ([sender] if sender in peers else []) + [node for node in peers if node != sender]
+
+        for node in sources:
+            try:
+                r = blockchain.http.get(f"{node}/block/{data['index']}", timeout=3)
+                if r.status_code == 200 and r.json().get("hash") == data["hash"]:
+                    block_dict = r.json()
+                    break
+            except Exception as e:
+                print(f"⚠️  Could not fetch block {data['index']} from {node}: {e}")
+
+        if block_dict is None:
+            return jsonify({"message": f"Could not fetch block {data['index']}"}), 502
+
+        return accept_incoming_block(block_dict)
+
+    # expand_compact_block already checked the rebuilt block's hash
+    return accept_incoming_block(block_dict, hash_verified=True)
+
+
+@app.route("/block/<int:index>", methods=["GET"])
+def get_block(index):
+    chain = blockchain.chain
+    if not 0 <= index < len(chain):
+        return jsonify({"error": f"No block {index}"}), 404
+    return jsonify(chain[index]), 200
+
+
+def accept_incoming_block(data, hash_verified=False):
+    """Append a full block received from a peer, or start a sync if it doesn't fit our tip"""
     new_block = Block.from_dict(data)
 
+    # Re-hash outside the lock: it touches no shared state, so blocks
+    # arriving together are checked in parallel rather than queued
+    if not hash_verified and new_block.compute_hash() != new_block.hash:
+        return jsonify({"message": "Invalid block hash"}), 400
+
     with lock:
         last_block = blockchain.chain[-1]
 
-        # If chain mismatch → trigger network sync
+        # If chain mismatch → trigger network sync (requests arriving
+        # before it runs are folded into the same sync)
         if last_block["hash"] != new_block.previous_hash:
-            threading.Thread(target=sync_with_network, daemon=True).start()
+            sync_event.set()
             return jsonify({"message": "Chain out of sync. Resolving..."}), 409
 
         # Accept the block
-        success, msg = blockchain.accept_block(data)
+        success, msg = blockchain.accept_block(data, hash_verified=True)
 
         if success:
+            if new_block.index % SYNC_EVERY_N_BLOCKS == 0:
+                sync_event.set()
             return jsonify({"message": msg}), 200
         else:
             return jsonify({"message": msg}), 400
@@ -408,26 +573,27 @@ def get_chain():
     """
     Get the entire blockchain.
 
-    FIXED: Handles both Block objects and dicts (when loaded from database)
+    Streamed block by block, so the whole chain is never serialized into
+    one response buffer.
     """
     valid, msg = blockchain.is_chain_valid()
 
-    # Handle both Block objects and dicts
-    chain_data = []
-    for block in blockchain.chain:
-        if isinstance(block, dict):
-            # Already a dict (loaded from DB)
-            chain_data.append(block)
-        else:
-            # Block object, convert to dict
-            chain_data.append(block.to_dict())
+    # Snapshot the list and its length: mining only appends, and a chain
+    # replacement swaps in a new list, so this view stays consistent
+    chain = blockchain.chain
+    length = len(chain)
 
-    return jsonify({
-        "chain": chain_data,
-        "length": len(blockchain.chain),
-        "valid": valid,
-        "message": msg
-    }), 200
+    # Blocks are encoded with stdlib json, like the block hash: orjson
+    # would turn a NaN / Infinity from an old chain into null, and the
+    # peer would then reject the block's hash
+    def generate():
+        yield '{"length":%d,"valid":%s,"message":%s,"chain":[' % (
+            length, json.dumps(valid), json.dumps(msg))
+        for i in range(length):
+            yield json.dumps(chain[i]) if i == 0 else "," + json.dumps(chain[i])
+        yield "]}"
+
+    return Response(stream_with_context(generate()), status=200, mimetype="application/json")
 
 
 @app.route("/mempool", methods=["GET"])
@@ -438,13 +604,20 @@ def get_mempool():
     }), 200
 
 
+@app.route("/mempool/diff", methods=["POST"])
+def get_mempool_diff():
+    """Pending transactions the caller lacks, given the ids of those it has"""
+    missing = blockchain.mempool_diff(request.get_json().get("have", []))
+    return jsonify({"mempool": missing, "count": len(missing)}), 200
+
+
 @app.route("/history/<batch_id>", methods=["GET"])
 def get_history(batch_id):
     history = blockchain.get_history(batch_id)
     if not history:
         return jsonify({"message": f"No transactions found for batch {batch_id}", "history": []}), 404
 
-    history.sort(key=lambda h: h.get("block_timestamp", 0))
+    history = sorted(history, key=lambda h: h.get("block_timestamp", 0))
     formatted = [
         {
             "batch_id": h["batch_id"],
@@ -480,13 +653,14 @@ def register_node():
     return jsonify({
         "message": "Node registered successfully",
         "your_node": node_url,
-        "all_nodes": list(blockchain.nodes)
+        "all_nodes": blockchain.nodes_snapshot
     }), 201
 
 
 @app.route("/nodes", methods=["GET"])
 def get_nodes():
-    return jsonify({"nodes": list(blockchain.nodes), "count": len(blockchain.nodes)}), 200
+    nodes = blockchain.nodes_snapshot
+    return jsonify({"nodes": nodes, "count": len(nodes)}), 200
 
 
 @app.route("/status", methods=["GET"])
@@ -576,14 +750,15 @@ def list_actors():
 
 # ------------------ CONSENSUS & AUTO-MINING ------------------
 def periodic_consensus():
-    """Periodic sync with network every 30 seconds"""
+    """Sync with network every SYNC_INTERVAL seconds, or sooner when sync_event is set"""
     time.sleep(10)  # Wait for node to stabilize
     while True:
         try:
             sync_with_network()
         except Exception as e:
             print(f"❌ Sync error: {e}")
-        time.sleep(30)
+        sync_event.wait(timeout=SYNC_INTERVAL)
+        sync_event.clear()
 
 
 def auto_mining_daemon():
@@ -644,6 +819,8 @@ if __name__ == "__main__":
     parser.add_argument("--difficulty", type=int, default=2)
     parser.add_argument("--no-crypto", action="store_true", help="Disable cryptographic signatures")
     parser.add_argument("--no-auto-mine", action="store_true", help="Disable automatic mining")
+    parser.add_argument("--pow-workers", type=int, default=1,
+                        help="Processes used for proof-of-work (only worth it at high difficulty)")
     args = parser.parse_args()
 
     PORT = args.port
@@ -660,7 +837,8 @@ if __name__ == "__main__":
         difficulty=args.difficulty,
         bootstrap_nodes=bootstrap_nodes,
         enable_crypto=not args.no_crypto,
-        max_mempool_size=1000
+        max_mempool_size=1000,
+        pow_workers=args.pow_workers
     )
 
     print(f"\n{'=' * 60}")
@@ -670,6 +848,7 @@ if __name__ == "__main__":
     print(f"🏠 Hostname: {blockchain.hostname}")
     print(f"💾 Database: {db_file}")
     print(f"⛏️  Difficulty: {blockchain.difficulty}")
+    print(f"🧵 PoW workers: {blockchain.pow_workers}")
     print(f"🔐 Cryptography: {'ENABLED' if blockchain.enable_crypto else 'DISABLED'}")
     print(f"⛏️  Auto-mining: {'ENABLED' if not args.no_auto_mine else 'DISABLED'}")
     print(f"🌐 Bootstrap: {bootstrap_nodes if bootstrap_nodes else 'None (Standalone)'}")
@@ -692,6 +871,7 @@ if __name__ == "__main__":
         print("✅ Standalone node ready immediately\n")
 
     # Start background daemons
+    threading.Thread(target=broadcast_worker, daemon=True).start()
     threading.Thread(target=periodic_consensus, daemon=True).start()
 
     if not args.no_auto_mine:
@@ -700,4 +880,7 @@ if __name__ == "__main__":
     if bootstrap_nodes:
         threading.Thread(target=register_with_bootstrap_nodes, daemon=True).start()
 
-    app.run(host="0.0.0.0", port=PORT, debug=False, use_reloader=False)
\ No newline at end of file
+    try:
+        app.run(host="0.0.0.0", port=PORT, debug=False, use_reloader=False)
+    finally:
+        blockchain.close()
\ No newline at end of file
@@ -30,9 +30,14 @@ db = "/app/blockchain_5000.db"
 try:
     conn = sqlite3.connect(db)
     cur = conn.cursor()
-    # Replace the latest block's product name "Laptops" -> "CORRUPTED"
+    # Blocks are stored as msgpack BLOBs, so swap the product name for one of
+    # the same length ("Laptops" -> "CORRUPT"): the string's length prefix
+    # stays valid and the row still decodes, it just no longer hashes right
+    (block,) = cur.execute("SELECT block FROM chain ORDER BY idx DESC LIMIT 1").fetchone()
+    if b"Laptops" not in block:
+        raise RuntimeError("latest block has no 'Laptops' to corrupt")
     cur.execute("""UPDATE chain
-                   SET block = replace(block, '"Laptops"', '"CORRUPTED"')
+                   SET block = CAST(replace(CAST(block AS TEXT), 'Laptops', 'CORRUPT') AS BLOB)
                    WHERE idx = (SELECT MAX(idx) FROM chain);""")
     conn.commit()
     cur.close()
@@ -56,7 +61,7 @@ else
     # fallback 1: try sqlite3 CLI inside container
     if docker exec blockchain_node_1 sqlite3 /app/blockchain_5000.db "SELECT name FROM sqlite_master LIMIT 1;" >/dev/null 2>&1; then
         docker exec blockchain_node_1 sqlite3 /app/blockchain_5000.db \
-          "UPDATE chain SET block = replace(block, '\"Laptops\"', '\"CORRUPTED\"') WHERE idx = (SELECT MAX(idx) FROM chain);" \
+          "UPDATE chain SET block = CAST(replace(CAST(block AS TEXT), 'Laptops', 'CORRUPT') AS BLOB) WHERE idx = (SELECT MAX(idx) FROM chain);" \
           && echo "Corruption applied with sqlite3 CLI inside container."
     else
         # fallback 2: try to find host mount and run sqlite3 from host (if available)
@@ -74,7 +79,7 @@ else
         if [ -n "$HOST_DB" ] && [ -f "$HOST_DB" ]; then
             echo "Found host DB at: $HOST_DB"
             if command -v sqlite3 >/dev/null 2>&1; then
-                sqlite3 "$HOST_DB" "UPDATE chain SET block = replace(block, '\"Laptops\"', '\"CORRUPTED\"') WHERE idx = (SELECT MAX(idx) FROM chain);" \
+                sqlite3 "$HOST_DB" "UPDATE chain SET block = CAST(replace(CAST(block AS TEXT), 'Laptops', 'CORRUPT') AS BLOB) WHERE idx = (SELECT MAX(idx) FROM chain);" \
                   && echo "Corruption applied on host-mounted DB via sqlite3."
             else
                 echo "Host does not have sqlite3 CLI. Copying DB out, modifying with python, copying back..."
@@ -84,7 +89,7 @@ else
 import sqlite3
 conn = sqlite3.connect("$TMP_DB")
 cur = conn.cursor()
-cur.execute("""UPDATE chain SET block = replace(block, '"Laptops"', '"CORRUPTED"') WHERE idx = (SELECT MAX(idx) FROM chain);""")
+cur.execute("""UPDATE chain SET block = CAST(replace(CAST(block AS TEXT), 'Laptops', 'CORRUPT') AS BLOB) WHERE idx = (SELECT MAX(idx) FROM chain);""")
 conn.commit()
 conn.close()
 PY
@@ -120,7 +125,7 @@ curl -s http://localhost:5000/status | jq '{valid: .chain_valid, peers: .peers}'
 
 # Check data restored
 PRODUCT=$(curl -s http://localhost:5000/verify/$BATCH | jq -r '.events[0].metadata.product' 2>/dev/null || echo "")
-echo -e "\nProduct name: $PRODUCT (should be 'Laptops', not 'CORRUPTED')"
+echo -e "\nProduct name: $PRODUCT (should be 'Laptops', not 'CORRUPT')"
 
 if [ "$PRODUCT" == "Laptops" ]; then
     echo "✅ AUTO-HEAL TEST PASSED!"